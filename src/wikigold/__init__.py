@@ -29,6 +29,10 @@ app.config.from_mapping(
     MYSQL_PASSWORD=os.getenv('MYSQL_PASSWORD', default=''),
     MYSQL_DATABASE=os.getenv('MYSQL_DATABASE', default='wikigold'),
     REDIS_URL = os.getenv('REDIS_URL', default='redis://localhost:6379'),
+    REDIS_CHUNK_SIZE=os.getenv('REDIS_CHUNK_SIZE', default='1000'),  # keys per MGET or pipeline
+    LABELS_BACKEND=os.getenv('LABELS_BACKEND', default='redis'),  # redis or mmap
+    LABEL_INDEX_PATH=os.getenv('LABEL_INDEX_PATH', default=''),  # empty means the default path in wikigold_data
+    LABEL_BLOOM_FILTER=os.getenv('LABEL_BLOOM_FILTER', default='0'),  # prefilter candidate labels with bloom filter
     BASE_URL=os.getenv('BASE_URL', default=''),
     PREFIX=os.getenv('PREFIX', default=''),
     KNOWLEDGE_BASE=os.getenv('KNOWLEDGE_BASE', default='1'),
@@ -39,9 +43,11 @@ app.config.from_mapping(
 
 # config types mapping
 app.config['MYSQL_PORT'] = int(app.config['MYSQL_PORT'])
+app.config['REDIS_CHUNK_SIZE'] = int(app.config['REDIS_CHUNK_SIZE'])
 app.config['KNOWLEDGE_BASE'] = int(app.config['KNOWLEDGE_BASE'])
 app.config['MAX_NGRAMS'] = int(app.config['MAX_NGRAMS'])
 app.config['TOKENS_LIMIT'] = int(app.config['TOKENS_LIMIT'])
+app.config['LABEL_BLOOM_FILTER'] = bool(int(app.config['LABEL_BLOOM_FILTER']))
 
 app.wsgi_app = PrefixMiddleware(app.wsgi_app, prefix=app.config['PREFIX'])
 
@@ -57,6 +63,21 @@ enterprisedump.init_app(app)
 from . import cache
 cache.init_app(app)
 
+from . import labeltrie
+labeltrie.init_app(app)
+
+from . import labelindex
+labelindex.init_app(app)
+
+from . import bloomfilter
+bloomfilter.init_app(app)
+
+from . import redirects
+redirects.init_app(app)
+
+from . import titlehash
+titlehash.init_app(app)
+
 from . import auth
 app.register_blueprint(auth.bp)
 
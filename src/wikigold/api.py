@@ -9,26 +9,56 @@ from flask import (
 from .db import get_db
 from .helper import get_lines, normalize_algorithm_json, get_user_decisions, get_ground_truth_decisions, absolute_url_for
 from .mediawikixml import normalize_title
+from .redirects import get_redirects
+from .titlehash import title_hash
 
 bp = Blueprint('api', __name__, url_prefix='/api')
 
 
-def search_article_by_title(title, dump_id, ground_truth=None):
+def select_titles_targets(titles, dump_id):
+    """Return the dictionary of the titles found in the dump to the final targets of their redirect chains."""
     db = get_db()
     cursor = db.cursor(dictionary=True)
-    sql = 'SELECT `id` FROM `articles` WHERE `title`=%s AND `dump_id`=%s'
-    data = (title, dump_id)
+    sql = 'WITH RECURSIVE `chain` (`source_title`, `id`, `redirect_to_id`, `depth`) AS (' \
+          'SELECT `title`, `id`, `redirect_to_id`, 0 FROM `articles` ' \
+          f'WHERE `dump_id`=%s AND `title_hash` IN ({", ".join(["%s"] * len(titles))}) ' \
+          f'AND `title` IN ({", ".join(["%s"] * len(titles))}) ' \
+          'UNION ALL ' \
+          'SELECT `chain`.`source_title`, `articles`.`id`, `articles`.`redirect_to_id`, `chain`.`depth` + 1 ' \
+          'FROM `chain` JOIN `articles` ON `articles`.`id`=`chain`.`redirect_to_id` WHERE `chain`.`depth` < 64) ' \
+          'SELECT `source_title`, `id` FROM `chain` WHERE `redirect_to_id` IS NULL'
+    data = (dump_id, *map(title_hash, titles), *titles)
     cursor.execute(sql, data)
-    article = cursor.fetchone()
-    if article is None:  # try with normalized title
-        data = (normalize_title(title), dump_id)
-        cursor.execute(sql, data)
-        article = cursor.fetchone()
-    if article is None:  # normalized title doesn't work
+    targets = {row['source_title']: row['id'] for row in cursor}
+    cursor.close()
+    return targets
+
+
+def search_article_by_title(title, dump_id, ground_truth=None):
+    """Redirect to the article with the title or the normalized title. The redirects are resolved to their targets."""
+    titles = (title, normalize_title(title))
+    article_id = None
+    redirects = get_redirects(dump_id, load_from_db=False)
+    if redirects is not None:
+        # the articles found by the title hashes are checked by their titles
+        candidates = {id: title for id, title in zip(redirects.lookup_titles(titles), titles) if id is not None}
+        if len(candidates) > 0:
+            db = get_db()
+            cursor = db.cursor(dictionary=True)
+            sql = f'SELECT `id`, `title` FROM `articles` WHERE `id` IN ({", ".join(["%s"] * len(candidates))})'
+            cursor.execute(sql, tuple(candidates))
+            found_titles = {row['title']: row['id'] for row in cursor if candidates[row['id']] == row['title']}
+            cursor.close()
+            article_id = next((found_titles[title] for title in titles if title in found_titles), None)
+        if article_id is not None:
+            article_id = int(redirects.resolve([article_id])[0])
+    if article_id is None:  # the redirects of the dump are not built or the title hashes collide
+        targets = select_titles_targets(titles, dump_id)
+        article_id = next((targets[title] for title in titles if title in targets), None)
+    if article_id is None:  # normalized title doesn't work
         response = make_response(jsonify({'title': 'article not found'}), 404)
         abort(response)
-    cursor.close()
-    return redirect(absolute_url_for('api.get_article', id=article['id'], ground_truth=ground_truth))
+    return redirect(absolute_url_for('api.get_article', id=article_id, ground_truth=ground_truth))
 
 
 def search_article_by_metadata(query, dump_id, ground_truth=None):
@@ -0,0 +1,64 @@
+"""
+Articles' counters and redirects of a dump held in NumPy arrays indexed by the article id.
+
+The arrays take a few bytes per article instead of the Python dictionaries of ints, so the commands that need the
+counters or the redirect targets of all the articles (e.g. cache-labels) can load them for the largest dumps.
+"""
+
+import numpy as np
+from tqdm import tqdm
+
+from .db import get_db
+from .redirects import get_redirects
+
+
+class ArticleArrays:
+    def __init__(self, first_id, counters, redirect_targets):
+        """Element i of the arrays describes the article with id first_id + i. counters are the article counters
+        increased by the counters of the redirects to the article. redirect_targets are the ids of the final
+        articles of the redirect chains (the article's own id for the articles that are not redirects)."""
+        self.first_id = first_id
+        self.counters = counters
+        self.redirect_targets = redirect_targets
+
+    def __len__(self):
+        return len(self.counters)
+
+    def resolve_redirect(self, article_id):
+        return int(self.redirect_targets[article_id - self.first_id])
+
+    def counter(self, article_id):
+        return int(self.counters[article_id - self.first_id])
+
+
+def load_article_arrays(dump_id, fetch_size=100000):
+    """Load the articles' counters of the dump. The redirect targets are the ones of the dump's redirects."""
+    redirects = get_redirects(dump_id)
+    first_id = redirects.first_id
+    redirect_targets = redirects.targets
+    counters = np.zeros(len(redirect_targets), dtype=np.uint32)
+    if len(counters) == 0:
+        return ArticleArrays(first_id, counters, redirect_targets)
+
+    db = get_db()
+    cursor = db.cursor()
+
+    sql = 'SELECT `id`, `counter` FROM `articles` WHERE `dump_id`=%s'
+    cursor.execute(sql, (dump_id,))
+    with tqdm(total=len(counters), desc='loading counters') as pbar:
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if len(rows) == 0:
+                break
+            ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows)) - first_id
+            counters[ids] = np.fromiter((row[1] for row in rows), dtype=np.uint32, count=len(rows))
+            pbar.update(len(rows))
+    cursor.close()
+
+    # update counters of the redirects' targets
+    redirects_mask = redirect_targets != np.arange(first_id, first_id + len(counters), dtype=np.uint32)
+    resolved_counters = counters.copy()
+    np.add.at(resolved_counters, redirect_targets[redirects_mask].astype(np.int64) - first_id,
+              counters[redirects_mask])
+
+    return ArticleArrays(first_id, resolved_counters, redirect_targets)
@@ -0,0 +1,137 @@
+"""
+Bloom filter over all labels of a dump.
+
+The retrieval checks the candidate n-grams against the filter before looking them up in the labels cache, so most of
+the n-grams that are not labels never reach the cache. The filter has no false negatives and its false positive rate
+is set when it is built with the build-label-bloom-filter command.
+"""
+
+import hashlib
+import math
+import os.path
+import struct
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from tqdm import tqdm
+
+from .db import get_db
+from .helper import get_data_dir
+
+filter_magic = b'WGBF'
+filter_format_version = 1
+
+# magic, version, bits count, hashes count
+header_struct = struct.Struct('<4sIQI')
+
+bloom_filters = {}
+
+
+class BloomFilter:
+    def __init__(self, bits_count, hashes_count, bits=None):
+        self.bits_count = bits_count
+        self.hashes_count = hashes_count
+        if bits is None:
+            bits = bytearray(-(-bits_count // 8))
+        self.bits = bits
+
+    @classmethod
+    def for_capacity(cls, items_count, error_rate):
+        """Create the filter with the optimal number of bits and hashes for the expected number of items."""
+        items_count = max(items_count, 1)
+        bits_count = math.ceil(-items_count * math.log(error_rate) / math.log(2) ** 2)
+        hashes_count = max(round(bits_count / items_count * math.log(2)), 1)
+        return cls(bits_count, hashes_count)
+
+    def positions(self, key):
+        # double hashing: the positions are h1 + i*h2
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little')
+        for i in range(self.hashes_count):
+            yield (h1 + i * h2) % self.bits_count
+
+    def add(self, key):
+        bits = self.bits
+        for position in self.positions(key):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        bits = self.bits
+        for position in self.positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def filter(self, keys):
+        """Return the keys that may be in the set."""
+        return [key for key in keys if key in self]
+
+    def save(self, path):
+        with open(path, 'wb') as file:
+            file.write(header_struct.pack(filter_magic, filter_format_version, self.bits_count, self.hashes_count))
+            file.write(self.bits)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as file:
+            magic, version, bits_count, hashes_count = header_struct.unpack(file.read(header_struct.size))
+            if magic != filter_magic or version != filter_format_version:
+                raise ValueError(f'unsupported bloom filter: {path}')
+            bits = bytearray(file.read())
+        return cls(bits_count, hashes_count, bits)
+
+
+def get_label_bloom_filter_path(dump_id):
+    return os.path.join(get_data_dir(), f'labels-bloom-{dump_id}.bin')
+
+
+def get_label_bloom_filter(dump_id=None):
+    """Return the labels' bloom filter of the dump or None if LABEL_BLOOM_FILTER is disabled. The filter is loaded
+    once per process."""
+    if not current_app.config['LABEL_BLOOM_FILTER']:
+        return None
+    if dump_id is None:
+        dump_id = current_app.config['KNOWLEDGE_BASE']
+
+    if dump_id not in bloom_filters:
+        path = get_label_bloom_filter_path(dump_id)
+        if not os.path.exists(path):
+            raise Exception(f'labels bloom filter for dump {dump_id} not found. run build-label-bloom-filter first')
+        bloom_filters[dump_id] = BloomFilter.load(path)
+
+    return bloom_filters[dump_id]
+
+
+@click.command('build-label-bloom-filter')
+@click.argument('dump_id', type=int)
+@click.option('-r', '--error-rate', type=float, default=0.01, help='false positive rate of the filter')
+@with_appcontext
+def build_label_bloom_filter_command(dump_id, error_rate):
+    db = get_db()
+    cursor = db.cursor(dictionary=True)
+
+    sql = 'SELECT COUNT(*) AS `labels_count` FROM `labels` WHERE `dump_id`=%s'
+    cursor.execute(sql, (dump_id,))
+    labels_count = cursor.fetchone()['labels_count']
+    print(f'labels count: {labels_count}')
+
+    bloom_filter = BloomFilter.for_capacity(labels_count, error_rate)
+    print(f'bits: {bloom_filter.bits_count} hashes: {bloom_filter.hashes_count}')
+
+    sql = 'SELECT `label` FROM `labels` WHERE `dump_id`=%s'
+    cursor.execute(sql, (dump_id,))
+    with tqdm(total=labels_count) as pbar:
+        for row in cursor:
+            bloom_filter.add(row['label'])
+            pbar.update(1)
+    cursor.close()
+
+    path = get_label_bloom_filter_path(dump_id)
+    print(f'saving bloom filter to: {path}')
+    bloom_filter.save(path)
+
+
+def init_app(app):
+    app.cli.add_command(build_label_bloom_filter_command)
@@ -0,0 +1,118 @@
+"""
+Bulk writer used by the dump and dataset importers.
+
+The writer allocates the ids of the articles and lines on the client side, so the rows referencing them can be
+queued before the articles and lines are written. The queued rows are flushed with executemany, which the connector
+sends as multi-row INSERTs. The tables are flushed in the order they were first used, so the referenced rows are always
+written before the rows referencing them.
+
+The transaction is committed only in commit_if_due, which the importers call after the last row of each article, so
+a commit never contains a part of an article. The writer's on_commit callback runs in the committed transaction, e.g.
+to save the import checkpoint atomically with the rows.
+
+A batch is also flushed before its rows would exceed half of the server's max_allowed_packet (the other half is left
+for the escaping of the values), so the batches of long lines or tokens fit into a single packet.
+
+The ids are allocated from the current maximum id of the table, so only one writer may import into the database at
+a time.
+"""
+
+
+def row_size(values):
+    """Return the approximate size of the row's values in the INSERT statement."""
+    size = 0
+    for value in values:
+        if isinstance(value, str):
+            size += len(value.encode('utf-8'))
+        elif isinstance(value, (bytes, bytearray)):
+            size += len(value)
+        else:
+            size += 20
+    return size
+
+
+class BulkWriter:
+    def __init__(self, db, batch_size=1000, commit_interval=10000, on_commit=None, max_batch_bytes=None):
+        """batch_size is the number of rows queued for a table before all the tables are flushed. The transaction is
+        committed in commit_if_due after at least commit_interval rows were added. on_commit is called with the cursor
+        before each commit. max_batch_bytes is the size limit of a multi-row INSERT (by default half of the server's
+        max_allowed_packet)."""
+        self.db = db
+        self.cursor = db.cursor()
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.on_commit = on_commit
+        self.max_batch_bytes = max_batch_bytes
+        self.next_ids = {}
+        self.rows = {}
+        self.rows_bytes = {}
+        self.sql_inserts = {}
+        self.uncommitted_rows_count = 0
+        self.rows_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.db.rollback()
+            self.cursor.close()
+
+    def allocate_id(self, table):
+        if table not in self.next_ids:
+            self.cursor.execute(f'SELECT COALESCE(MAX(`id`), 0) + 1 FROM `{table}`')
+            self.next_ids[table] = self.cursor.fetchone()[0]
+        allocated_id = self.next_ids[table]
+        self.next_ids[table] += 1
+        return allocated_id
+
+    def add(self, table, row):
+        """Queue the row (a dictionary of column values). All the rows of a table must have the same columns."""
+        if table not in self.rows:
+            columns = ', '.join(f'`{column}`' for column in row)
+            values = ', '.join(['%s'] * len(row))
+            self.sql_inserts[table] = f'INSERT INTO `{table}` ({columns}) VALUES ({values})'
+            self.rows[table] = []
+            self.rows_bytes[table] = 0
+        if self.max_batch_bytes is None:
+            self.cursor.execute('SELECT @@max_allowed_packet')
+            self.max_batch_bytes = self.cursor.fetchone()[0] // 2
+        size = row_size(row.values())
+        if len(self.rows[table]) > 0 and self.rows_bytes[table] + size > self.max_batch_bytes:
+            self.flush()
+        self.rows[table].append(tuple(row.values()))
+        self.rows_bytes[table] += size
+        self.uncommitted_rows_count += 1
+        if len(self.rows[table]) >= self.batch_size:
+            self.flush()
+
+    def add_with_id(self, table, row):
+        """Queue the row with a client-side allocated id and return the id."""
+        row_id = self.allocate_id(table)
+        self.add(table, {'id': row_id, **row})
+        return row_id
+
+    def flush(self):
+        for table, rows in self.rows.items():
+            if len(rows) > 0:
+                self.cursor.executemany(self.sql_inserts[table], rows)
+                self.rows_count += len(rows)
+                rows.clear()
+                self.rows_bytes[table] = 0
+
+    def commit_if_due(self):
+        if self.uncommitted_rows_count >= self.commit_interval:
+            self.commit()
+
+    def commit(self):
+        self.flush()
+        if self.on_commit is not None:
+            self.on_commit(self.cursor)
+        self.db.commit()
+        self.uncommitted_rows_count = 0
+
+    def close(self):
+        self.commit()
+        self.cursor.close()
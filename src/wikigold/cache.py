@@ -5,18 +5,31 @@ The cache commands should be run in the following order:
 1. cache-labels
 2. cache-backlinks
 3. cache-labels-counters (optional)
+
+Labels and backlinks are stored in a compact binary format (see encode_label and encode_backlinks). The first byte of
+each value is the format version. Caches created with pickle or the previous formats can be converted with the
+migrate-cache command. The labels' keyphraseness and sense probabilities are precomputed when the labels are cached.
 """
 
+import multiprocessing
+import os
 import pickle
+import shutil
+import struct
+import time
+from itertools import groupby, islice
 
+import numpy as np
 import redis
 import click
 from flask import current_app, g
 from flask.cli import with_appcontext
 from tqdm import tqdm
 
-from .db import get_db
-from .helper import get_lines, ngrams
+from .articlearrays import load_article_arrays
+from .db import connect_db, get_db
+from .helper import get_data_dir, get_lines, ngrams
+from .labelindex import get_label_index
 
 
 def get_redis(db_name=None):
@@ -39,185 +52,492 @@ def get_redis(db_name=None):
     return g.redis[db]
 
 
+def get_labels_store():
+    """Return the store of the cached labels selected with LABELS_BACKEND: redis or the memory-mapped label index.
+    Both support get() and mget() with the label names."""
+    if current_app.config['LABELS_BACKEND'] == 'mmap':
+        return get_label_index()
+    return get_redis('labels')
+
+
+label_format_version = 2
+backlinks_format_version = 1
+
+# version, flags, label_counter, appeared_in, as_link_in, keyphraseness
+label_header_struct = struct.Struct('<BBIIId')
+# article_id, article_counter, label_article_counter, sense_probability, label_sense_probability
+label_article_struct = struct.Struct('<IIIdd')
+label_flag_counters = 1  # 'appeared_in', 'as_link_in' and 'keyphraseness' are set
+
+# format version 1 of labels: version, flags, label_counter, appeared_in, as_link_in
+label_header_struct_v1 = struct.Struct('<BBIII')
+# format version 1 of labels: article_id, article_counter, label_article_counter
+label_article_struct_v1 = struct.Struct('<III')
+
+# version, delta width in bytes, backlinks count, first backlink
+backlinks_header_struct = struct.Struct('<BBII')
+
+pickle_protocol_opcode = 0x80
+
+
+def add_label_probabilities(label):
+    """Calculate keyphraseness and the sense probabilities of the label's articles. The articles are reordered by
+    descending sense probability."""
+    if 'as_link_in' in label and 'appeared_in' in label:  # we have 'as_link_in' and 'appeared_in' cached
+        if label['appeared_in'] != 0:
+            label['keyphraseness'] = label['as_link_in'] / label['appeared_in']
+        else:
+            label['keyphraseness'] = 0.0
+
+    articles = label['articles']
+    article_counter_sum = sum([article['article_counter'] for article in articles.values()])
+    label_article_counter_sum = sum([article['label_article_counter'] for article in articles.values()])
+    for article in articles.values():
+        article['sense_probability'] = article['article_counter'] / article_counter_sum \
+            if article_counter_sum > 0 else 0.0
+        article['label_sense_probability'] = article['label_article_counter'] / label_article_counter_sum \
+            if label_article_counter_sum > 0 else 0.0
+
+    label['articles'] = dict(sorted(articles.items(),
+                                    key=lambda item: (-item[1]['sense_probability'], item[0])))
+    return label
+
+
+def encode_label(label):
+    """Pack the label into the header followed by (article_id, article_counter, label_article_counter,
+    sense_probability, label_sense_probability) records sorted by descending sense probability. The probabilities
+    are calculated from the counters, so they stay valid after the counters are updated."""
+    label = add_label_probabilities(label)
+
+    flags = 0
+    appeared_in, as_link_in, keyphraseness = 0, 0, 0.0
+    if 'keyphraseness' in label:
+        flags |= label_flag_counters
+        appeared_in, as_link_in, keyphraseness = label['appeared_in'], label['as_link_in'], label['keyphraseness']
+
+    header = label_header_struct.pack(label_format_version, flags, label['label_counter'],
+                                      appeared_in, as_link_in, keyphraseness)
+    articles = [label_article_struct.pack(article_id, article['article_counter'], article['label_article_counter'],
+                                          article['sense_probability'], article['label_sense_probability'])
+                for article_id, article in label['articles'].items()]
+    return header + b''.join(articles)
+
+
+def decode_label(data):
+    """Returns {'label_counter': int, 'articles': {article_id: {...}}} with the articles sorted by descending sense
+    probability. If the label counters are cached, 'appeared_in', 'as_link_in' and 'keyphraseness' are set too."""
+    if data[0] == pickle_protocol_opcode:  # not migrated cache
+        return add_label_probabilities(pickle.loads(data))
+    elif data[0] == 1:
+        return decode_label_v1(data)
+
+    version, flags, label_counter, appeared_in, as_link_in, keyphraseness = label_header_struct.unpack_from(data)
+    if version != label_format_version:
+        raise ValueError(f'unsupported label format version: {version}')
+
+    label = {'label_counter': label_counter, 'articles': {}}
+    if flags & label_flag_counters:
+        label['appeared_in'] = appeared_in
+        label['as_link_in'] = as_link_in
+        label['keyphraseness'] = keyphraseness
+
+    label_articles = label['articles']
+    for article_id, article_counter, label_article_counter, sense_probability, label_sense_probability in \
+            label_article_struct.iter_unpack(memoryview(data)[label_header_struct.size:]):
+        label_articles[article_id] = {'article_counter': article_counter,
+                                      'label_article_counter': label_article_counter,
+                                      'sense_probability': sense_probability,
+                                      'label_sense_probability': label_sense_probability}
+    return label
+
+
+def decode_label_v1(data):
+    version, flags, label_counter, appeared_in, as_link_in = label_header_struct_v1.unpack_from(data)
+
+    label = {'label_counter': label_counter, 'articles': {}}
+    if flags & label_flag_counters:
+        label['appeared_in'] = appeared_in
+        label['as_link_in'] = as_link_in
+
+    for article_id, article_counter, label_article_counter in \
+            label_article_struct_v1.iter_unpack(memoryview(data)[label_header_struct_v1.size:]):
+        label['articles'][article_id] = {'article_counter': article_counter,
+                                         'label_article_counter': label_article_counter}
+    return add_label_probabilities(label)
+
+
+def encode_backlinks(article_backlinks):
+    """Pack the backlinks as sorted article ids. The first id is stored in the header and the rest as deltas
+    using the narrowest unsigned integer type that fits the largest delta."""
+    article_backlinks = np.unique(np.fromiter(article_backlinks, dtype=np.uint32, count=len(article_backlinks)))
+    if len(article_backlinks) == 0:
+        return backlinks_header_struct.pack(backlinks_format_version, 1, 0, 0)
+
+    deltas = np.diff(article_backlinks)
+    max_delta = int(deltas.max()) if len(deltas) > 0 else 0
+    for width in (1, 2, 4):
+        if max_delta < 1 << (8 * width):
+            break
+
+    header = backlinks_header_struct.pack(backlinks_format_version, width, len(article_backlinks),
+                                          int(article_backlinks[0]))
+    return header + deltas.astype(f'<u{width}').tobytes()
+
+
+def decode_backlinks(data):
+    if data[0] == pickle_protocol_opcode:  # not migrated cache
+        return pickle.loads(data)
+
+    version, width, count, first = backlinks_header_struct.unpack_from(data)
+    if version != backlinks_format_version:
+        raise ValueError(f'unsupported backlinks format version: {version}')
+    if count == 0:
+        return set()
+
+    deltas = np.frombuffer(data, dtype=f'<u{width}', count=count - 1, offset=backlinks_header_struct.size)
+    article_backlinks = np.empty(count, dtype=np.int64)
+    article_backlinks[0] = first
+    np.cumsum(deltas, dtype=np.int64, out=article_backlinks[1:])
+    article_backlinks[1:] += first
+    return set(article_backlinks.tolist())
+
+
+cache_format_versions = {
+    'labels': label_format_version,
+    'backlinks': backlinks_format_version,
+}
+
+
+def set_cache_format_version(db_name):
+    r = get_redis()
+    r.set(f'{db_name}_format_version', cache_format_versions[db_name])
+
+
+def get_cache_format_version(db_name):
+    """Return the format version of all values of the cache or None if it is not known (e.g. a pickled cache)."""
+    r = get_redis()
+    version = r.get(f'{db_name}_format_version')
+    return int(version) if version is not None else None
+
+
+def chunks(items, chunk_size=None):
+    """Split items into lists of at most chunk_size elements. By default REDIS_CHUNK_SIZE is used."""
+    if chunk_size is None:
+        chunk_size = current_app.config['REDIS_CHUNK_SIZE']
+
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, chunk_size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
 def get_cached_backlinks(article_id):
     r = get_redis('backlinks')
     article_backlinks = r.get(article_id)
     if article_backlinks is not None:
-        article_backlinks = pickle.loads(article_backlinks)
+        article_backlinks = decode_backlinks(article_backlinks)
     else:
         article_backlinks = set()
     return article_backlinks
 
 
+def get_cached_backlinks_many(article_ids, chunk_size=None):
+    """Batch version of get_cached_backlinks. Returns dictionary article_id: backlinks set."""
+    r = get_redis('backlinks')
+    backlinks = {}
+    for article_ids_chunk in chunks(article_ids, chunk_size):
+        for article_id, article_backlinks in zip(article_ids_chunk, r.mget(article_ids_chunk)):
+            if article_backlinks is not None:
+                backlinks[article_id] = decode_backlinks(article_backlinks)
+            else:
+                backlinks[article_id] = set()
+    return backlinks
+
+
 def add_backlinks_to_cache(article_id, article_backlinks):
     r = get_redis('backlinks')
-    r.set(article_id, pickle.dumps(article_backlinks))
+    r.set(article_id, encode_backlinks(article_backlinks))
 
 
-def get_cached_label(label_name):
-    r = get_redis('labels')
+def get_cached_label(label_name, r=None):
+    if r is None:
+        r = get_labels_store()
     label = r.get(label_name)
     if label is not None:
-        label = pickle.loads(label)
+        label = decode_label(label)
     return label
 
 
+def get_cached_labels(label_names, chunk_size=None, r=None):
+    """Batch version of get_cached_label. Returns dictionary label_name: label with the cached labels only."""
+    if r is None:
+        r = get_labels_store()
+    labels = {}
+    for label_names_chunk in chunks(label_names, chunk_size):
+        for label_name, label in zip(label_names_chunk, r.mget(label_names_chunk)):
+            if label is not None:
+                labels[label_name] = decode_label(label)
+    return labels
+
+
 def add_label_to_cache(label_name, label):
     r = get_redis('labels')
-    r.set(label_name, pickle.dumps(label))
+    r.set(label_name, encode_label(label))
 
 
 @click.command('cache-labels')
 @click.argument('dump_id', type=int)
-@click.option('-p', '--page-size', type=int, default=500000)
-@click.option('-s', '--start-page', type=int, default=0)
+@click.option('-s', '--start-label-id', type=int, default=0, help='continue caching from a specified label id')
 @with_appcontext
-def cache_labels_command(dump_id, page_size, start_page):
+def cache_labels_command(dump_id, start_label_id):
+    """Cache the labels of the dump. The labels' senses are streamed in a single query ordered by label, so each label
+    is assembled in memory exactly once and written with pipelined SETs."""
     db = get_db()
+    r = get_redis('labels')
 
-    cursor = db.cursor(dictionary=True)
-    sql = 'SELECT COUNT(*) AS `articles_with_redirects_count` FROM `articles` WHERE `dump_id`=%s'
-    cursor.execute(sql, (dump_id,))
-    articles_with_redirects_count = cursor.fetchone()['articles_with_redirects_count']
-    print(f'articles with redirects count: {articles_with_redirects_count}')
-
-    sql = '''SELECT `id`, `counter`, `redirect_to_id` FROM `articles` WHERE `articles`.`dump_id`=%s'''
-    data = (dump_id,)
-    cursor.execute(sql, data)
-    articles = {}
-    redirects = {}
-    with tqdm(total=articles_with_redirects_count) as pbar:
-        for row in cursor:
-            articles[row['id']] = row['counter']
-            if row['redirect_to_id'] is not None:
-                redirects[row['id']] = row['redirect_to_id']
-            pbar.update(1)
-
-    with tqdm(total=len(redirects)) as pbar:
-        for redirect_id, destination_id in redirects.items():
-            while destination_id in redirects:
-                destination_id = redirects[destination_id]
-            articles[destination_id] += articles[redirect_id] # update counters
-            redirects[redirect_id] = destination_id
-            pbar.update(1)
+    article_arrays = load_article_arrays(dump_id)
 
-    sql = '''SELECT COUNT(*) AS `labels_articles_count` FROM `labels_articles` 
-                JOIN `labels` ON `labels_articles`.`label_id`=`labels`.`id` WHERE `dump_id`=%s'''
-    cursor.execute(sql, (dump_id,))
+    cursor = db.cursor(dictionary=True)
+    sql = '''SELECT COUNT(*) AS `labels_articles_count` FROM `labels_articles`
+                JOIN `labels` ON `labels_articles`.`label_id`=`labels`.`id`
+                WHERE `labels`.`dump_id`=%s AND `labels`.`id`>=%s AND `labels_articles`.`article_id` IS NOT NULL'''
+    cursor.execute(sql, (dump_id, start_label_id))
     labels_articles_count = cursor.fetchone()['labels_articles_count']
     print(f'labels articles count: {labels_articles_count}')
+    cursor.close()
 
-    sql = '''SELECT MIN(`labels_articles`.`id`) AS `first_id` FROM `labels_articles`
-                JOIN `labels` ON `labels_articles`.`label_id` = `labels`.`id` WHERE `labels`.`dump_id`=%s'''
-    cursor.execute(sql, (dump_id,))
-    first_id = cursor.fetchone()['first_id']
+    def cached_labels(rows):
+        """Assemble the labels from the rows ordered by label id."""
+        for (label_id, label_name, label_counter), label_rows in groupby(rows, key=lambda row: row[:3]):
+            label_articles = {}
+            for _, _, _, article_id, label_article_counter in label_rows:
+                article_id = article_arrays.resolve_redirect(article_id)
 
-    print(f'first id: {first_id}')
-    steps = -(-labels_articles_count//page_size) - start_page
-    with tqdm(total=steps) as pbar:
-        for i in range(start_page*page_size, labels_articles_count, page_size):
-            start_id = first_id + i
-            end_id = min(start_id+page_size-1, labels_articles_count)
+                if article_id in label_articles:  # update counters
+                    label_articles[article_id]['label_article_counter'] += label_article_counter
+                else:
+                    label_articles[article_id] = {'article_counter': article_arrays.counter(article_id),
+                                                  'label_article_counter': label_article_counter}
+            yield label_id, label_name, {'label_counter': label_counter, 'articles': label_articles}
+
+    cursor = db.cursor()
+    sql = '''SELECT `labels`.`id`, `labels`.`label`, `labels`.`counter`, `labels_articles`.`article_id`,
+                    `labels_articles`.`counter`
+                FROM `labels_articles` JOIN `labels` ON `labels`.`id` = `labels_articles`.`label_id`
+                WHERE `labels`.`dump_id`=%s AND `labels`.`id`>=%s AND `labels_articles`.`article_id` IS NOT NULL
+                ORDER BY `labels_articles`.`label_id`'''
+    cursor.execute(sql, (dump_id, start_label_id))
+
+    rows_count = 0
+    labels_count = 0
+
+    def counted_rows():
+        nonlocal rows_count
+        for row in cursor:
+            rows_count += 1
+            yield row
+
+    start = time.time()
+    with tqdm(total=labels_articles_count) as pbar:
+        for labels_chunk in chunks(cached_labels(counted_rows())):
+            pipeline = r.pipeline(transaction=False)
+            for label_id, label_name, label in labels_chunk:
+                pipeline.set(label_name, encode_label(label))
+            pipeline.execute()
+
+            labels_count += len(labels_chunk)
+            pbar.set_postfix(last_label_id=labels_chunk[-1][0], labels=labels_count)
+            pbar.update(rows_count - pbar.n)
+    cursor.close()
+    elapsed = time.time() - start
 
-            pbar.set_description(f'processing ids from {start_id} to {end_id}')
+    set_cache_format_version('labels')
 
-            sql = f'''SELECT `labels`.`label`, `labels`.`counter` AS `label_counter`, `labels_articles`.`article_id`,
-                            `labels_articles`.`counter` AS `label_article_counter`
-                        FROM `labels_articles` JOIN `labels` ON `labels`.`id` = `labels_articles`.`label_id`
-                        WHERE `labels_articles`.`article_id` IS NOT NULL AND `labels_articles`.`id` BETWEEN %s AND %s'''
-            data = (start_id, end_id)
-            cursor.execute(sql, data)
+    print(f'cached {labels_count} labels from {rows_count} rows in {elapsed:.2f} s '
+          f'({rows_count / max(elapsed, 1e-9):.2f} rows/s, {labels_count / max(elapsed, 1e-9):.2f} labels/s)')
 
-            labels = {}
-            for row in cursor:
-                label_name = row['label']
-                label_counter = row['label_counter']
 
-                if label_name in labels:
-                    label = labels[label_name]
-                else:
-                    label = get_cached_label(label_name)
-                    if label is None:
-                        label = {'label_counter': label_counter,
-                                 'articles': {}}
-                    labels[label_name] = label
-
-                label_articles = label['articles']
-                article_id = row['article_id']
-                if article_id in redirects:
-                    article_id = redirects[article_id]
-                article_counter = articles[article_id]
+def iterate_articles_links_labels(articles_ids, ground_truth_id):
+    """Yield (article_id, set of labels linked in the article) for the ascending articles_ids.
+    The labels come from a single query ordered by `source_article_id` which is streamed in lockstep with
+    the articles."""
+    if len(articles_ids) == 0:
+        return
 
-                if article_id in label_articles:  # update counters
-                    label_articles[article_id]['label_article_counter'] += row['label_article_counter']
-                else:
-                    label_articles[article_id] = {'article_counter': article_counter,
-                                                  'label_article_counter': row['label_article_counter']}
-
-            for label_name, label_data in labels.items():
-                add_label_to_cache(label_name, label_data)
+    db = connect_db()  # the stream stays open while get_db() is used for the articles' lines
+    cursor = db.cursor()
+    sql = '''SELECT `source_article_id`, `label` FROM `ground_truth_decisions`
+                WHERE `ground_truth_id`=%s AND `source_article_id` BETWEEN %s AND %s
+                ORDER BY `source_article_id`'''
+    cursor.execute(sql, (ground_truth_id, articles_ids[0], articles_ids[-1]))
 
-            pbar.update(1)
-        cursor.close()
+    try:
+        links_groups = groupby(cursor, key=lambda row: row[0])
+        links_article_id, links = next(links_groups, (None, None))
+        for article_id in articles_ids:
+            while links_article_id is not None and links_article_id < article_id:
+                links_article_id, links = next(links_groups, (None, None))
+            if links_article_id == article_id:
+                yield article_id, {label for _, label in links}
+            else:
+                yield article_id, set()
+    finally:
+        db.close()
 
 
-def get_wikipedia_decisions_labels_set(article_id):
+def get_wikipedia_ground_truth_id(dump_id):
     db = get_db()
     cursor = db.cursor(dictionary=True)
-    sql = '''SELECT `label` FROM `wikipedia_decisions` WHERE `source_article_id`=%s'''
-    data = (article_id,)
-    cursor.execute(sql, data)
-
-    labels = set()
-    for row in cursor:
-        labels.add(row['label'])
+    sql = 'SELECT `id` FROM `ground_truth` WHERE `dump_id`=%s AND `name`=%s'
+    cursor.execute(sql, (dump_id, 'wikipedia'))
+    results = cursor.fetchall()
     cursor.close()
+    if len(results) != 1:
+        raise Exception(f'cannot find wikipedia ground truth for dump {dump_id}')
+    return results[0]['id']
 
-    return labels
+
+def count_labels_in_articles(articles_ids, ground_truth_id, labels_set):
+    """Return dictionary label_name: [appeared_in, as_link_in] with the number of the articles in which the label
+    appears as an n-gram and as a Wikipedia link. Only the labels from labels_set are counted."""
+    labels_counters = {}
+    for article_id, wikipedia_labels_set in iterate_articles_links_labels(articles_ids, ground_truth_id):
+        try:
+            lines = get_lines(article_id)  # raises ValueError
+            article_ngrams = {ngram['name'] for ngram in ngrams(lines)}
+            for label in article_ngrams:
+                if label in labels_set:
+                    label_counters = labels_counters.setdefault(label, [0, 0])
+                    label_counters[0] += 1
+                    if label in wikipedia_labels_set:
+                        label_counters[1] += 1
+        except ValueError:
+            print(f'cannot tokenize article: {article_id}. skipping')
+    return labels_counters
+
+
+# state of the cache-labels-counters worker processes, inherited from the parent process
+counters_worker = {}
+
+
+def init_counters_worker(app, ground_truth_id, labels_set, checkpoint_dir):
+    counters_worker['app'] = app
+    counters_worker['ground_truth_id'] = ground_truth_id
+    counters_worker['labels_set'] = labels_set
+    counters_worker['checkpoint_dir'] = checkpoint_dir
+
+
+def get_counters_checkpoint_path(checkpoint_dir, shard_nr):
+    return os.path.join(checkpoint_dir, f'shard-{shard_nr}.pickle')
+
+
+def count_labels_in_shard(shard):
+    """Count the labels in the shard and save the partial counters as the shard checkpoint."""
+    shard_nr, articles_ids = shard
+    with counters_worker['app'].app_context():
+        labels_counters = count_labels_in_articles(articles_ids, counters_worker['ground_truth_id'],
+                                                   counters_worker['labels_set'])
+
+    checkpoint_path = get_counters_checkpoint_path(counters_worker['checkpoint_dir'], shard_nr)
+    with open(checkpoint_path + '.tmp', 'wb') as file:
+        pickle.dump(labels_counters, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(checkpoint_path + '.tmp', checkpoint_path)  # the checkpoint exists only if it is complete
+
+    return len(articles_ids)
 
 
 @click.command('cache-labels-counters')
 @click.argument('dump_id', type=int)
+@click.option('-w', '--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+@click.option('-s', '--shard-size', type=int, default=10000, help='number of articles in a shard')
+@click.option('-g', '--ground-truth-id', type=int, default=-1,
+              help='ground truth with the Wikipedia links. By default the "wikipedia" ground truth of the dump')
 @with_appcontext
-def cache_labels_counters_command(dump_id):
+def cache_labels_counters_command(dump_id, workers, shard_size, ground_truth_id):
+    """Count the labels' appearances in the dump articles. The articles are split into shards which are counted by the
+    worker processes. Each finished shard is checkpointed, so the interrupted command resumes from the unfinished
+    shards of the same ground truth and shard size."""
     db = get_db()
     r = get_redis('labels')
 
-    labels_counters = {}
+    if ground_truth_id == -1:
+        ground_truth_id = get_wikipedia_ground_truth_id(dump_id)
+
+    labels_set = set()
     nb_labels = r.dbsize()
     with tqdm(total=nb_labels) as pbar:
         for label_name in r.scan_iter("*"):
             label_name = label_name.decode('utf-8')
-            labels_counters[label_name] = {'appeared_in': 0, 'as_link_in': 0}
+            labels_set.add(label_name)
             pbar.update(1)
 
     cursor = db.cursor(dictionary=True)
-    sql = 'SELECT `id` FROM `articles` WHERE `dump_id`=%s AND `redirect_to_title` IS NULL'
+    sql = 'SELECT `id` FROM `articles` WHERE `dump_id`=%s AND `redirect_to_title` IS NULL ORDER BY `id`'
     cursor.execute(sql, (dump_id, ))
     articles_ids = [row['id'] for row in cursor]
     cursor.close()
 
-    with tqdm(total=len(articles_ids)) as pbar:
-        for article_id in articles_ids:
-            try:
-                lines = get_lines(article_id)  # raises ValueError
-                wikipedia_labels_set = get_wikipedia_decisions_labels_set(article_id)
-                article_ngrams = {ngram['name'] for ngram in ngrams(lines)}
-                for label in article_ngrams:
-                    if label in labels_counters:
-                        labels_counters[label]['appeared_in'] += 1
-                        if label in wikipedia_labels_set:
-                            labels_counters[label]['as_link_in'] += 1
-            except ValueError:
-                print(f'cannot tokenize article: {article_id}. skipping')
-            pbar.update(1)
-
-    with tqdm(total=nb_labels) as pbar:
-        for label_name, label_counters in labels_counters.items():
-            label = get_cached_label(label_name)
-            label.update(label_counters)
-            add_label_to_cache(label_name, label)
-            pbar.update(1)
+    checkpoint_dir = os.path.join(get_data_dir(), f'labels-counters-{dump_id}-{ground_truth_id}-{shard_size}')
+    if not os.path.exists(checkpoint_dir):
+        os.mkdir(checkpoint_dir)
+
+    shards = [(shard_nr, articles_ids[start:start + shard_size])
+              for shard_nr, start in enumerate(range(0, len(articles_ids), shard_size))]
+    pending_shards = [shard for shard in shards
+                      if not os.path.exists(get_counters_checkpoint_path(checkpoint_dir, shard[0]))]
+    print(f'shards: {len(shards)} already counted: {len(shards) - len(pending_shards)}')
+
+    start = time.time()
+    articles_counted = 0
+    pending_articles_count = sum([len(articles_ids) for _, articles_ids in pending_shards])
+    init_counters_worker(current_app._get_current_object(), ground_truth_id, labels_set, checkpoint_dir)
+    with tqdm(total=len(articles_ids), initial=len(articles_ids) - pending_articles_count) as pbar:
+        if workers > 1:
+            # forked workers share labels_set with the parent process
+            with multiprocessing.get_context('fork').Pool(workers, initializer=init_counters_worker,
+                                                          initargs=(counters_worker['app'], ground_truth_id,
+                                                                    labels_set, checkpoint_dir)) as pool:
+                for shard_articles_count in pool.imap_unordered(count_labels_in_shard, pending_shards):
+                    articles_counted += shard_articles_count
+                    pbar.update(shard_articles_count)
+        else:
+            for shard in pending_shards:
+                shard_articles_count = count_labels_in_shard(shard)
+                articles_counted += shard_articles_count
+                pbar.update(shard_articles_count)
+    counting_elapsed = time.time() - start
+
+    # merge partial counters
+    labels_counters = {label_name: [0, 0] for label_name in labels_set}
+    for shard_nr, _ in tqdm(shards, desc='merging shards'):
+        with open(get_counters_checkpoint_path(checkpoint_dir, shard_nr), 'rb') as file:
+            for label_name, (appeared_in, as_link_in) in pickle.load(file).items():
+                label_counters = labels_counters.get(label_name)
+                if label_counters is None:  # the shard was counted before the labels were cached again
+                    continue
+                label_counters[0] += appeared_in
+                label_counters[1] += as_link_in
+
+    start = time.time()
+    with tqdm(total=nb_labels, desc='saving counters') as pbar:
+        for label_names in chunks(labels_counters.keys()):
+            pipeline = r.pipeline(transaction=False)
+            for label_name, label in get_cached_labels(label_names, r=r).items():
+                label['appeared_in'], label['as_link_in'] = labels_counters[label_name]
+                pipeline.set(label_name, encode_label(label))
+            pipeline.execute()
+            pbar.update(len(label_names))
+    saving_elapsed = time.time() - start
+
+    set_cache_format_version('labels')
+    shutil.rmtree(checkpoint_dir)
+
+    print(f'counted {articles_counted} articles in {counting_elapsed:.2f} s '
+          f'({articles_counted / max(counting_elapsed, 1e-9):.2f} articles/s, {workers} workers)')
+    print(f'saved {len(labels_counters)} labels in {saving_elapsed:.2f} s '
+          f'({len(labels_counters) / max(saving_elapsed, 1e-9):.2f} labels/s)')
 
 
 @click.command('cache-backlinks')
@@ -269,6 +589,39 @@ def cache_backlinks_command(ground_truth_id, page_size, start_page):
             pbar.update(1)
         cursor.close()
 
+    set_cache_format_version('backlinks')
+
+
+@click.command('migrate-cache')
+@click.argument('db_name', type=click.Choice(['labels', 'backlinks']))
+@with_appcontext
+def migrate_cache_command(db_name):
+    """Convert the pickled values or values in the previous formats into the current binary format. The cache in the
+    current format is not scanned."""
+    if get_cache_format_version(db_name) == cache_format_versions[db_name]:
+        print(f'{db_name} cache already in format version {cache_format_versions[db_name]}')
+        return
+
+    r = get_redis(db_name)
+    if db_name == 'labels':
+        decode, encode = decode_label, encode_label
+    else:
+        decode, encode = decode_backlinks, encode_backlinks
+
+    migrated = 0
+    with tqdm(total=r.dbsize()) as pbar:
+        for keys in chunks(r.scan_iter(count=current_app.config['REDIS_CHUNK_SIZE'])):
+            pipeline = r.pipeline(transaction=False)
+            for key, value in zip(keys, r.mget(keys)):
+                if value is not None and value[0] != cache_format_versions[db_name]:
+                    pipeline.set(key, encode(decode(value)))
+                    migrated += 1
+            pipeline.execute()
+            pbar.update(len(keys))
+
+    set_cache_format_version(db_name)
+    print(f'migrated values: {migrated}')
+
 
 @click.command('flush-db')
 @click.argument('db_name')
@@ -276,6 +629,8 @@ def cache_backlinks_command(ground_truth_id, page_size, start_page):
 def flush_db_command(db_name):
     r = get_redis(db_name)
     r.flushdb()
+    if db_name in cache_format_versions:
+        get_redis().delete(f'{db_name}_format_version')
 
 
 @click.command('flush-all')
@@ -289,6 +644,7 @@ def init_app(app):
     app.cli.add_command(cache_labels_command)
     app.cli.add_command(cache_labels_counters_command)
     app.cli.add_command(cache_backlinks_command)
+    app.cli.add_command(migrate_cache_command)
     app.cli.add_command(flush_db_command)
     app.cli.add_command(flush_all_command)
 
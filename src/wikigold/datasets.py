@@ -9,7 +9,10 @@ from flask.cli import with_appcontext
 def load_dataset(name, path):
     from datetime import datetime
     from flask import current_app
+    from .bulkwriter import BulkWriter
     from .db import get_db
+    from .helper import pack_line_tokens
+    from .titlehash import check_title_hash_columns
 
     if name not in globals():
         raise NameError('unknown loader')
@@ -17,6 +20,7 @@ def load_dataset(name, path):
 
     db = get_db()
     cursor = db.cursor()
+    check_title_hash_columns(cursor)
 
     sql = "INSERT INTO dumps (`lang`, `name`, `timestamp`) VALUES (%s, %s, %s)"
     data = ('en', name, datetime.now().isoformat())
@@ -30,42 +34,43 @@ def load_dataset(name, path):
     cursor.execute(sql, data)
     ground_truth_id = cursor.lastrowid
 
-    for title, caption, metadata, lines, decisions in dataset_iterator(path):
-        sql = "INSERT INTO `articles` (`title`, `caption`, `dump_id`) VALUES (%s, %s, %s)"
-        data = (title, caption, dump_id)
-        cursor.execute(sql, data)
-        article_id = cursor.lastrowid
-
-        for key, value in metadata.items():
-            sql = "INSERT INTO `articles_metadata` (`article_id`, `key`, `value`) VALUES (%s, %s, %s)"
-            data = (article_id, key, value)
-            cursor.execute(sql, data)
-
-        lines_nr_id = {}
-        for nr, line in lines.items():
-            sql = "INSERT INTO `lines` (`nr`, `content`, `article_id`) VALUES (%s, %s, %s)"
-            data = (nr, line, article_id)
-            cursor.execute(sql, data)
-            lines_nr_id[nr] = cursor.lastrowid
-
-        for link in decisions:
-            sql = '''INSERT INTO `ground_truth_decisions`
-            (`source_article_id`, `source_line_id`, `start`, `length`, `label`, `destination_title`, `ground_truth_id`)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)'''
-            data = (article_id, lines_nr_id[link['line']], link['start'], link['length'], link['label'],
-                    link['destination'], ground_truth_id)
-            cursor.execute(sql, data)
+    db.commit()
+
+    with BulkWriter(db) as writer:
+        for title, caption, metadata, lines, decisions in dataset_iterator(path):
+            article_id = writer.add_with_id('articles', {'title': title, 'caption': caption, 'dump_id': dump_id})
+
+            for key, value in metadata.items():
+                writer.add('articles_metadata', {'article_id': article_id, 'key': key, 'value': value})
+
+            lines_nr_id = {}
+            for nr, line in lines.items():
+                lines_nr_id[nr] = writer.add_with_id('lines', {'nr': nr, 'content': line,
+                                                               'tokens': pack_line_tokens(line),
+                                                               'article_id': article_id})
+
+            for link in decisions:
+                writer.add('ground_truth_decisions', {'source_article_id': article_id,
+                                                      'source_line_id': lines_nr_id[link['line']],
+                                                      'start': link['start'], 'length': link['length'],
+                                                      'label': link['label'], 'destination_title': link['destination'],
+                                                      'ground_truth_id': ground_truth_id})
+            writer.commit_if_due()
 
     # update destination ids
     print('updating destination ids...')
-    sql = '''UPDATE `ground_truth_decisions` INNER JOIN `articles` ON `ground_truth_decisions`.`destination_title`=`articles`.`title`
+    sql = '''UPDATE `ground_truth_decisions` INNER JOIN `articles`
+                ON `ground_truth_decisions`.`destination_title_hash`=`articles`.`title_hash`
+                    AND `ground_truth_decisions`.`destination_title`=`articles`.`title`
                 SET `ground_truth_decisions`.`destination_article_id` = `articles`.`id`
                 WHERE `ground_truth_decisions`.`ground_truth_id`=%s AND `articles`.`dump_id`=%s'''
     cursor.execute(sql, (ground_truth_id, knowledge_base_id))
 
     # update labels ids
     print('updating labels ids...')
-    sql = '''UPDATE `ground_truth_decisions` INNER JOIN `labels` ON `ground_truth_decisions`.`label`=`labels`.`label`
+    sql = '''UPDATE `ground_truth_decisions` INNER JOIN `labels`
+                    ON `ground_truth_decisions`.`label_hash`=`labels`.`label_hash`
+                        AND `ground_truth_decisions`.`label`=`labels`.`label`
                     SET `ground_truth_decisions`.`label_id` = `labels`.`id`
                     WHERE `ground_truth_decisions`.`ground_truth_id`=%s AND `labels`.`dump_id`=%s'''
     cursor.execute(sql, (ground_truth_id, knowledge_base_id))
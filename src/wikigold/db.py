@@ -6,15 +6,20 @@ from flask.cli import with_appcontext
 from werkzeug.security import generate_password_hash
 
 
+def connect_db():
+    """Open a new connection, e.g. for streaming a query while the g.db connection is used for other queries."""
+    return mysql.connector.connect(
+        host=current_app.config['MYSQL_HOST'],
+        port=current_app.config['MYSQL_PORT'],
+        user=current_app.config['MYSQL_USER'],
+        password=current_app.config['MYSQL_PASSWORD'],
+        database=current_app.config['MYSQL_DATABASE'],
+    )
+
+
 def get_db():
     if 'db' not in g:
-        g.db = mysql.connector.connect(
-            host=current_app.config['MYSQL_HOST'],
-            port=current_app.config['MYSQL_PORT'],
-            user=current_app.config['MYSQL_USER'],
-            password=current_app.config['MYSQL_PASSWORD'],
-            database=current_app.config['MYSQL_DATABASE'],
-        )
+        g.db = connect_db()
 
     return g.db
 
@@ -3,7 +3,7 @@ from math import log2
 
 from flask import current_app
 
-from .cache import get_cached_backlinks
+from .cache import get_cached_backlinks_many
 from .db import get_db
 
 
@@ -87,8 +87,9 @@ def add_relatedness_to_labels_dict(labels_dict):
     context_terms = {label_name: label
                       for label_name, label in labels_dict.items()
                       if len(label['articles']) == 1}
-    context_terms_articles_ids = [label['articles'][0]['article_id'] for label in context_terms.values()]
-    context_terms_backlinks = backlinks(context_terms_articles_ids)
+    # fetch backlinks of the context terms and all the candidate articles at once
+    articles_ids = {article['article_id'] for label in labels_dict.values() for article in label['articles']}
+    articles_backlinks = backlinks(articles_ids)
 
     if len(context_terms) == 0:
         raise Exception('cannot apply relatedness: no context terms available')
@@ -99,8 +100,8 @@ def add_relatedness_to_labels_dict(labels_dict):
         for ctx_to_ctx_label_name, ctx_to_ctx_label in context_terms.items():
             ctx_to_ctx_article_id = ctx_to_ctx_label['articles'][0]['article_id']
             if context_term_article_id != ctx_to_ctx_article_id:
-                context_term_avg_relatedness += semantic_relatedness(context_terms_backlinks[context_term_article_id],
-                                                                     context_terms_backlinks[ctx_to_ctx_article_id],
+                context_term_avg_relatedness += semantic_relatedness(articles_backlinks[context_term_article_id],
+                                                                     articles_backlinks[ctx_to_ctx_article_id],
                                                                      articles_count)
         if len(context_terms) > 1:
             context_term_avg_relatedness /= len(context_terms)-1
@@ -112,24 +113,20 @@ def add_relatedness_to_labels_dict(labels_dict):
     for label_name, label in labels_dict.items():
         for article in label['articles']:
             article_id = article['article_id']
-            article_backlinks = get_cached_backlinks(article_id)
+            article_backlinks = articles_backlinks[article_id]
             article['relatedness'] = 0.0
             for context_term_label_name, context_term_label in context_terms.items():
                 context_term_article_id = context_term_label['articles'][0]['article_id']
                 article['relatedness'] += context_term_label['context_term_weight'] *\
-                                          semantic_relatedness(context_terms_backlinks[context_term_article_id],
+                                          semantic_relatedness(articles_backlinks[context_term_article_id],
                                                                article_backlinks, articles_count)
 
             article['relatedness'] /= len(context_terms)
 
 
 def backlinks(article_ids):
-    backlinks = {}
     # loads backlinks from cache
-    for article_id in article_ids:
-        backlinks[article_id] = get_cached_backlinks(article_id)
-
-    return backlinks
+    return get_cached_backlinks_many(article_ids)
 
 
 def semantic_relatedness(article_a_backlinks, article_b_backlinks, articles_count):
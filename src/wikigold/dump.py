@@ -1,4 +1,6 @@
 import bz2
+import contextlib
+import io
 import json
 import sys
 import time
@@ -14,8 +16,12 @@ import click
 from flask import current_app, g
 from flask.cli import with_appcontext
 
+from .bulkwriter import BulkWriter
 from .db import get_db
-from .mediawikixml import iterate_xml_dump, normalize_title, iterate_xml_dump_parsed
+from .helper import get_data_dir, pack_line_tokens
+from .mediawikixml import iterate_xml_dump, iterate_xml_dump_parsed, iterate_multistream_dump_parsed, \
+    iterate_xml_dump_find, page_tags, read_page
+from .titlehash import check_title_hash_columns, sql_title_hash
 
 import mwparallelparser
 
@@ -31,36 +37,43 @@ import mwparallelparser
 @click.option('-d', '--dump-id', type=int, default=-1, help='continue the import for a specified dump id')
 @click.option('-g', '--ground-truth-id', type=int, default=-1, help='continue the import for a specified ground truth')
 @click.option('-s', '--start-step', type=int, default=1, help='continue the import from a specified step')
+@click.option('-b', '--batch-size', type=int, default=1000, help='number of rows inserted at once in step 1')
+@click.option('-c', '--commit-interval', type=int, default=10000, help='number of rows inserted between commits in '
+                                                                       'step 1')
+@click.option('--multistream/--no-multistream', default=False, help='import the multistream dump of the articles')
+@click.option('-w', '--workers', type=int, default=1, help='number of processes parsing the wikitext')
 @with_appcontext
-def import_dump_command(lang, dump_date, early_stopping, mirror, download, decompress, dump_id, ground_truth_id, start_step):
+def import_dump_command(lang, dump_date, early_stopping, mirror, download, decompress, dump_id, ground_truth_id, start_step,
+                        batch_size, commit_interval, multistream, workers):
     mirror = mirror.rstrip('/')
 
     filename = f'{lang}wiki-{dump_date}-pages-meta-current.xml'
     filename_bz2 = f'{lang}wiki-{dump_date}-pages-meta-current.xml.bz2'
     filename_metadata = f'{lang}wiki-{dump_date}-metadata.json'
 
-    url = f'{mirror}/{lang}wiki/{dump_date}/{filename_bz2}'
+    # the multistream dump is a concatenation of bz2 streams of about a hundred pages. the index lists the streams'
+    # offsets, so the streams can be decompressed and parsed in parallel
+    filename_multistream = f'{lang}wiki-{dump_date}-pages-articles-multistream.xml.bz2'
+    filename_multistream_index = f'{lang}wiki-{dump_date}-pages-articles-multistream-index.txt.bz2'
 
-    homedir = os.path.expanduser("~/")
-    if homedir == "~/":
-        raise ValueError('could not find a default download directory')
-
-    download_dir = os.path.join(homedir, 'wikigold_data')
-    if not os.path.exists(download_dir):
-        os.mkdir(download_dir)
+    download_dir = get_data_dir()
 
     filepath = os.path.join(download_dir, filename)
     filepath_bz2 = os.path.join(download_dir, filename_bz2)
     filepath_metadata = os.path.join(download_dir, filename_metadata)
+    filepath_multistream = os.path.join(download_dir, filename_multistream)
+    filepath_multistream_index = os.path.join(download_dir, filename_multistream_index)
 
     chunk_size = 1024
 
-    def download_xml_dump():
-        if not os.path.exists(filepath_bz2):
+    def download_dump_file(filename_download):
+        filepath_download = os.path.join(download_dir, filename_download)
+        if not os.path.exists(filepath_download):
+            url = f'{mirror}/{lang}wiki/{dump_date}/{filename_download}'
             r = requests.get(url, stream=True)
             total_size = int(r.headers['Content-Length'])
-            with open(filepath_bz2, 'wb') as file_bz2, tqdm(
-                    desc='downloading: ' + filename_bz2,
+            with open(filepath_download, 'wb') as file_bz2, tqdm(
+                    desc='downloading: ' + filename_download,
                     total=total_size,
                     unit='iB',
                     unit_scale=True,
@@ -89,17 +102,18 @@ def import_dump_command(lang, dump_date, early_stopping, mirror, download, decom
 
     def xml_dump_stream():
         if download and decompress:
-            download_xml_dump()
+            download_dump_file(filename_bz2)
             decompress_xml_dump()
             return open(filepath)
         elif download:
-            download_xml_dump()
+            download_dump_file(filename_bz2)
             return bz2.open(filepath_bz2)
         else:
             raise "downloading on fly not implemented"
 
     db = get_db()
     cursor = db.cursor()
+    check_title_hash_columns(cursor)
 
     sql_charter_maximum_length = '''SELECT character_maximum_length FROM information_schema.columns 
                                     WHERE table_name = %s AND column_name = %s'''
@@ -131,60 +145,59 @@ def import_dump_command(lang, dump_date, early_stopping, mirror, download, decom
     def step_1():
         print(f'step 1. processing dump...')
 
-        if not os.path.exists(filepath_metadata):
-            with xml_dump_stream() as dump:
-                print('collecting metadata ...', end=' ')
-                titles_in_ns0 = set()
-                for page in iterate_xml_dump(dump, tags=('ns', 'title')):
-                    ns = page['ns'].text.strip()
-                    title = page['title'].text
-                    if ns == '0':
-                        title = normalize_title(title)
-                        titles_in_ns0.add(title)
-
-                metadata = {'titles_in_ns0': list(titles_in_ns0)}
-                with open(filepath_metadata, 'w') as file:
-                    json.dump(metadata, file)
-                print('done')
+        if multistream:
+            if download:
+                download_dump_file(filename_multistream)
+                download_dump_file(filename_multistream_index)
+            dump = contextlib.nullcontext()
+            pages = iterate_multistream_dump_parsed(filepath_multistream, filepath_multistream_index, workers,
+                                                    early_stopping, lang)
         else:
-            print(f'loading metadata from: {filename_metadata}')
-            with open(filepath_metadata, 'r') as file:
-                metadata = json.load(file)
-            metadata['titles_in_ns0'] = set(metadata['titles_in_ns0'])
-
-        sql_add_article = "INSERT INTO `articles` (`title`, `caption`, `dump_id`) VALUES (%s, %s, %s)"
-        sql_add_article_redirect = "INSERT INTO `articles` (`title`, `redirect_to_title`, `dump_id`) VALUES (%s, %s, %s)"
-
-        sql_add_line = "INSERT INTO `lines` (`article_id`, `nr`, `content`) VALUES (%s, %s, %s)"
-        sql_add_wikipedia_decision = '''INSERT INTO `wikipedia_decisions`
-        (`source_article_id`, `source_line_id`, `start`, `length`, `label`, `destination_title`, `dump_id`) VALUES (%s, %s, %s, %s, %s, %s, %s)'''
-
-        with xml_dump_stream() as dump:
-            for title, lines, redirect_to, wikipedia_decisions in iterate_xml_dump_parsed(dump, metadata, early_stopping):
+            if not os.path.exists(filepath_metadata):
+                with xml_dump_stream() as dump:
+                    print('collecting metadata ...', end=' ')
+                    pages_in_ns0 = sum(1 for _ in iterate_xml_dump(dump, tags=('ns',), main_namespace_only=True))
+
+                    metadata = {'pages_in_ns0': pages_in_ns0}
+                    with open(filepath_metadata, 'w') as file:
+                        json.dump(metadata, file)
+                    print('done')
+            else:
+                print(f'loading metadata from: {filename_metadata}')
+                with open(filepath_metadata, 'r') as file:
+                    metadata = json.load(file)
+                if 'titles_in_ns0' in metadata:  # metadata of the older imports holds the list of the titles
+                    metadata = {'pages_in_ns0': len(metadata['titles_in_ns0'])}
+                    with open(filepath_metadata, 'w') as file:
+                        json.dump(metadata, file)
+            dump = xml_dump_stream()
+            pages = iterate_xml_dump_parsed(dump, metadata, early_stopping, workers, lang)
+
+        with dump, BulkWriter(db, batch_size, commit_interval) as writer:
+            for title, lines, lines_tokens, redirect_to, wikipedia_decisions in pages:
                 if len(title) > title_maximum_length:
                     print(f"title '{title[:title_maximum_length]}...' exceeds maximum length ({title_maximum_length})")
                     continue
 
                 if redirect_to is not None:
-                    data_article = (title, redirect_to, dump_id)
-                    cursor.execute(sql_add_article_redirect, data_article)
+                    writer.add_with_id('articles', {'title': title, 'caption': None, 'redirect_to_title': redirect_to,
+                                                    'dump_id': dump_id})
                 else:
                     try:
                         caption = lines[0]
                     except IndexError:
                         caption = None
-                    data_article = (title, caption, dump_id)
-                    cursor.execute(sql_add_article, data_article)
-                    article_id = cursor.lastrowid
+                    article_id = writer.add_with_id('articles', {'title': title, 'caption': caption,
+                                                                 'redirect_to_title': None, 'dump_id': dump_id})
 
-                    for line_nr, content in enumerate(lines):
+                    for line_nr, (content, tokens) in enumerate(zip(lines, lines_tokens)):
                         if len(content) > line_content_maximum_length:
                             print(
                                 f"line {title}({line_nr}): '{content[:50]}...' exceeds maximum length ({line_content_maximum_length})")
                             continue
-                        data_line = (article_id, line_nr, content)
-                        cursor.execute(sql_add_line, data_line)
-                        line_id = cursor.lastrowid
+                        line_id = writer.add_with_id('lines', {'article_id': article_id, 'nr': line_nr,
+                                                               'content': content,
+                                                               'tokens': tokens})
                         if line_nr in wikipedia_decisions:
                             for link in wikipedia_decisions[line_nr]:
                                 label = link['label']
@@ -198,9 +211,12 @@ def import_dump_command(lang, dump_date, early_stopping, mirror, download, decom
                                           f"exceeds maximum length ({title_maximum_length})")
                                     continue
 
-                                data_wikipedia_decision = (article_id, line_id, link['start'], link['length'], label, destination, dump_id)
-                                cursor.execute(sql_add_wikipedia_decision, data_wikipedia_decision)
-                db.commit()
+                                writer.add('wikipedia_decisions', {'source_article_id': article_id,
+                                                                   'source_line_id': line_id, 'start': link['start'],
+                                                                   'length': link['length'], 'label': label,
+                                                                   'destination_title': destination,
+                                                                   'dump_id': dump_id})
+                writer.commit_if_due()  # commit only whole articles
 
     def step_2():
         print('step 2. saving labels...', end=' ')
@@ -216,7 +232,9 @@ def import_dump_command(lang, dump_date, early_stopping, mirror, download, decom
         print('step 3. updating ground_truth_decisions destination_ids...', end=' ')
         start = time.time_ns()
         sql_update_ground_truth_decisions= '''
-        UPDATE `ground_truth_decisions` INNER JOIN `articles` ON `ground_truth_decisions`.`destination_title`=`articles`.`title`
+        UPDATE `ground_truth_decisions` INNER JOIN `articles`
+            ON `ground_truth_decisions`.`destination_title_hash`=`articles`.`title_hash`
+                AND `ground_truth_decisions`.`destination_title`=`articles`.`title`
             SET `ground_truth_decisions`.`destination_article_id` = `articles`.`id`
             WHERE `ground_truth_decisions`.`ground_truth_id`=%s AND `articles`.`dump_id`=%s'''
         cursor.execute(sql_update_ground_truth_decisions, (ground_truth_id, dump_id))
@@ -228,7 +246,9 @@ def import_dump_command(lang, dump_date, early_stopping, mirror, download, decom
         print('step 4. updating ground_truth_decisions label_ids...', end=' ')
         start = time.time_ns()
         sql_update_ground_truth_decisions = '''
-            UPDATE `ground_truth_decisions` INNER JOIN `labels` ON `ground_truth_decisions`.`label`=`labels`.`label`
+            UPDATE `ground_truth_decisions` INNER JOIN `labels`
+                ON `ground_truth_decisions`.`label_hash`=`labels`.`label_hash`
+                    AND `ground_truth_decisions`.`label`=`labels`.`label`
                 SET `ground_truth_decisions`.`label_id` = `labels`.`id`
                 WHERE `ground_truth_decisions`.`ground_truth_id`=%s AND `labels`.`dump_id`=%s'''
         cursor.execute(sql_update_ground_truth_decisions, (ground_truth_id, dump_id))
@@ -240,7 +260,8 @@ def import_dump_command(lang, dump_date, early_stopping, mirror, download, decom
         print('step 5. updating articles redirects...', end=' ')
         start = time.time_ns()
         sql_update_article_redirect = '''
-        UPDATE `articles` `a1` INNER JOIN `articles` `a2` ON `a1`.`redirect_to_title`=`a2`.`title`
+        UPDATE `articles` `a1` INNER JOIN `articles` `a2`
+            ON `a1`.`redirect_to_title_hash`=`a2`.`title_hash` AND `a1`.`redirect_to_title`=`a2`.`title`
             SET `a1`.`caption`=`a2`.`caption`, `a1`.`redirect_to_id`=`a2`.`id`
             WHERE `a1`.`dump_id`=%s AND `a2`.`dump_id`=%s'''
         data_article_redirect = (dump_id, dump_id)
@@ -252,10 +273,11 @@ def import_dump_command(lang, dump_date, early_stopping, mirror, download, decom
     def step_6():
         print('step 6. updating articles counters...', end=' ')
         start = time.time_ns()
-        sql_update_article_counter = '''UPDATE `articles` INNER JOIN
+        sql_update_article_counter = f'''UPDATE `articles` INNER JOIN
                                             (SELECT `destination_title`, COUNT(*) AS `counter` FROM `wikipedia_decisions`
                                                 WHERE `dump_id`=%s GROUP BY `destination_title`) `wd1`
-                                            ON `articles`.`title`=`wd1`.`destination_title`
+                                            ON `articles`.`title_hash`={sql_title_hash('`wd1`.`destination_title`')}
+                                                AND `articles`.`title`=`wd1`.`destination_title`
                                             SET `articles`.`counter`=`wd1`.`counter`
                                             WHERE `articles`.`dump_id`=%s'''
         cursor.execute(sql_update_article_counter, (dump_id, dump_id))
@@ -294,6 +316,60 @@ def import_dump_command(lang, dump_date, early_stopping, mirror, download, decom
     cursor.close()
 
 
+@click.command('tokenize-lines')
+@click.argument('dump_id', type=int)
+@click.option('-p', '--page-size', type=int, default=100000)
+@with_appcontext
+def tokenize_lines_command(dump_id, page_size):
+    """Store token spans for the lines of a dump imported before the `tokens` column existed."""
+    db = get_db()
+    cursor = db.cursor(dictionary=True)
+
+    sql = 'ALTER TABLE `lines` ADD COLUMN IF NOT EXISTS `tokens` LONGBLOB NULL AFTER `content`'
+    cursor.execute(sql)
+
+    sql = 'SELECT `lang` FROM `dumps` WHERE `id`=%s'
+    cursor.execute(sql, (dump_id,))
+    lang = cursor.fetchone()['lang']
+
+    sql = '''SELECT MIN(`lines`.`id`) AS `first_id`, MAX(`lines`.`id`) AS `last_id` FROM `lines`
+                JOIN `articles` ON `lines`.`article_id`=`articles`.`id` WHERE `articles`.`dump_id`=%s'''
+    cursor.execute(sql, (dump_id,))
+    row = cursor.fetchone()
+    first_id, last_id = row['first_id'], row['last_id']
+    if first_id is None:
+        print(f'no lines for dump: {dump_id}')
+        return
+    print(f'first id: {first_id} last id: {last_id}')
+
+    sql_select_lines = '''SELECT `lines`.`id`, `lines`.`content` FROM `lines`
+                            JOIN `articles` ON `lines`.`article_id`=`articles`.`id`
+                            WHERE `articles`.`dump_id`=%s AND `lines`.`tokens` IS NULL
+                                AND `lines`.`id` BETWEEN %s AND %s'''
+    sql_update_tokens = 'UPDATE `lines` SET `tokens`=%s WHERE `id`=%s'
+
+    steps = -(-(last_id - first_id + 1) // page_size)
+    with tqdm(total=steps) as pbar:
+        for start_id in range(first_id, last_id + 1, page_size):
+            end_id = start_id + page_size - 1
+            pbar.set_description(f'processing ids from {start_id} to {end_id}')
+
+            cursor.execute(sql_select_lines, (dump_id, start_id, end_id))
+            data_tokens = []
+            for row in cursor.fetchall():
+                tokens = pack_line_tokens(row['content'].decode('utf-8'), lang)
+                if tokens is None:
+                    print(f'cannot tokenize line: {row["id"]}. skipping')
+                    continue
+                data_tokens.append((tokens, row['id']))
+
+            cursor.executemany(sql_update_tokens, data_tokens)
+            db.commit()
+            pbar.update(1)
+
+    cursor.close()
+
+
 @click.command('delete-dump')
 @click.argument('dump_id', type=int)
 @with_appcontext
@@ -322,6 +398,46 @@ def delete_dump_command(dump_id):
     cursor.close()
     db.commit()
 
+def synthetic_xml_dump(pages_count, text_length):
+    """Return a dump of pages_count pages. Every third page is outside the main namespace and every seventh page is a
+    redirect."""
+    namespace = 'http://www.mediawiki.org/xml/export-0.11/'
+    wikitext = ('Lorem [[ipsum]] dolor sit amet &amp; consectetur.\n' * (text_length // 50 + 1))[:text_length]
+    pages = []
+    for page_nr in range(pages_count):
+        ns = '0' if page_nr % 3 else '1'
+        redirect = f'<redirect title="Destination {page_nr}" />' if page_nr % 7 == 0 else ''
+        pages.append(f'<page><title>Page {page_nr}</title><ns>{ns}</ns><id>{page_nr}</id>{redirect}'
+                     f'<revision><id>{page_nr}</id><timestamp>2022-01-01T00:00:00Z</timestamp>'
+                     f'<contributor><username>User</username><id>1</id></contributor><model>wikitext</model>'
+                     f'<format>text/x-wiki</format><text bytes="{len(wikitext)}" xml:space="preserve">{wikitext}</text>'
+                     f'<sha1>0</sha1></revision></page>')
+    return (f'<mediawiki xmlns="{namespace}" version="0.11"><siteinfo><sitename>Wikipedia</sitename></siteinfo>'
+            + ''.join(pages) + '</mediawiki>').encode('utf-8')
+
+
+@click.command('benchmark-xml-dump')
+@click.option('-n', '--pages-count', type=int, default=20000, help='number of the pages in the synthetic dump')
+@click.option('-l', '--text-length', type=int, default=3000, help='length of the wikitext of the pages')
+def benchmark_xml_dump_command(pages_count, text_length):
+    """Compare the reading time of the main namespace pages of a synthetic dump with iterate_xml_dump and the previous
+    implementation."""
+    dump = synthetic_xml_dump(pages_count, text_length)
+    print(f'pages: {pages_count} size: {len(dump) / 1024 / 1024:.2f} MiB')
+
+    implementations = {
+        'find': lambda source: filter(None, map(read_page, iterate_xml_dump_find(source, page_tags))),
+        'compiled': lambda source: map(read_page, iterate_xml_dump(source, page_tags, main_namespace_only=True)),
+    }
+    for name, read_pages in implementations.items():
+        start = time.time_ns()
+        pages_read = sum(1 for _ in read_pages(io.BytesIO(dump)))
+        elapsed = (time.time_ns() - start) / 1e9
+        print(f'{name}: {elapsed:.3f} s ({pages_read / elapsed:.0f} pages/s)')
+
+
 def init_app(app):
     app.cli.add_command(import_dump_command)
+    app.cli.add_command(tokenize_lines_command)
     app.cli.add_command(delete_dump_command)
+    app.cli.add_command(benchmark_xml_dump_command)
@@ -1,44 +1,404 @@
 import glob
 import json
+import multiprocessing.pool
 import re
+import shutil
+import subprocess
+import tarfile
+import threading
 import time
-from collections import defaultdict
+from collections import defaultdict, deque
 from datetime import datetime
+from functools import partial
 import os.path
 
+import mysql.connector
+from mysql.connector import errorcode
 from tqdm import tqdm
 
 import click
+from flask import current_app
 from flask.cli import with_appcontext
 
-from .db import get_db
+from .bulkwriter import BulkWriter
+from .db import connect_db, get_db
+from .helper import pack_line_tokens
+from .pipeline import Pipeline
+from .titlehash import check_title_hash_columns, title_hash_indexes
 from WHParallelParser import WHParallelParser
 import mwparallelparser
 
+# optional faster JSON decoders
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+
+# secondary indexes dropped before step 1 of the fast load and created (if missing) before step 3 of every import, so
+# an interrupted fast load continued without --fast-load restores them. the ground_truth_decisions indexes are not
+# a part of the schema. they speed up the chunks of steps 6 and 7.
+import_indexes = [
+    ('articles', 'articles_ix_title', '`title`'),
+    ('labels', 'labels_ix_label', '`label`'),
+    *title_hash_indexes,
+    ('ground_truth_decisions', 'ground_truth_decisions_ix_destination_article_id',
+     '`ground_truth_id`, `destination_article_id`'),
+    ('ground_truth_decisions', 'ground_truth_decisions_ix_label_id',
+     '`ground_truth_id`, `label_id`, `destination_title`, `destination_article_id`'),
+]
+
+
+def drop_import_indexes(cursor):
+    for table, index, _ in import_indexes:
+        print(f'dropping index {index}...')
+        cursor.execute(f'DROP INDEX IF EXISTS `{index}` ON `{table}`')
+
+
+def create_import_indexes(cursor):
+    for table, index, columns in import_indexes:
+        print(f'creating index {index}...')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS `{index}` ON `{table}`({columns})')
+
+
+sql_create_import_progress = '''CREATE TABLE IF NOT EXISTS `import_progress` (
+    `dump_id` INT UNSIGNED NOT NULL,
+    `step` INT UNSIGNED NOT NULL,
+    `position` BIGINT UNSIGNED NOT NULL,
+    `filename` VARCHAR(255) NULL,
+    `articles_processed` INT UNSIGNED NULL,
+    PRIMARY KEY (`dump_id`, `step`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin'''
+
+
+def get_import_progress(cursor, dump_id, step):
+    sql = 'SELECT `position` FROM `import_progress` WHERE `dump_id`=%s AND `step`=%s'
+    cursor.execute(sql, (dump_id, step))
+    row = cursor.fetchone()
+    return None if row is None else row[0]
+
+
+def set_import_progress(cursor, dump_id, step, position):
+    sql = '''INSERT INTO `import_progress` (`dump_id`, `step`, `position`) VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE `position`=VALUES(`position`)'''
+    cursor.execute(sql, (dump_id, step, position))
+
+
+def get_import_checkpoint(cursor, dump_id):
+    """Return the file name, the byte offset after the last committed article and the number of the processed
+    articles of step 1 or None if step 1 was not started."""
+    sql = '''SELECT `filename`, `position`, `articles_processed` FROM `import_progress`
+                WHERE `dump_id`=%s AND `step`=1'''
+    cursor.execute(sql, (dump_id,))
+    return cursor.fetchone()
+
+
+def set_import_checkpoint(cursor, dump_id, filename, position, articles_processed):
+    sql = '''INSERT INTO `import_progress` (`dump_id`, `step`, `position`, `filename`, `articles_processed`)
+                VALUES (%s, 1, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE `position`=VALUES(`position`), `filename`=VALUES(`filename`),
+                    `articles_processed`=VALUES(`articles_processed`)'''
+    cursor.execute(sql, (dump_id, position, filename, articles_processed))
+
+
+def delete_import_progress(cursor, dump_id, step):
+    sql = 'DELETE FROM `import_progress` WHERE `dump_id`=%s AND `step`=%s'
+    cursor.execute(sql, (dump_id, step))
+
+
+sql_disable_checks = 'SET SESSION `foreign_key_checks`=0, `unique_checks`=0'
+sql_enable_checks = 'SET SESSION `foreign_key_checks`=1, `unique_checks`=1'
+
+chunk_worker = threading.local()
+pool_connections = {}
+
+
+def init_chunk_worker(app, statements, fast_load=False):
+    with app.app_context():
+        chunk_worker.db = connect_db()
+    if fast_load:
+        cursor = chunk_worker.db.cursor()
+        cursor.execute(sql_disable_checks)
+        cursor.close()
+    pool_connections[threading.get_ident()] = chunk_worker.db
+    chunk_worker.statements = statements
+
+
+def run_chunk(id_range, max_attempts=5):
+    """Run the statements of a chunked step for the id range in the thread's own connection. The chunks running in
+    parallel may deadlock, so the chunk is repeated if the transaction was rolled back."""
+    cursor = chunk_worker.db.cursor()
+    for attempt in range(max_attempts):
+        try:
+            for sql, params in chunk_worker.statements:
+                cursor.execute(sql, params + id_range)
+            chunk_worker.db.commit()
+            break
+        except mysql.connector.errors.DatabaseError as e:
+            if e.errno != errorcode.ER_LOCK_DEADLOCK or attempt == max_attempts - 1:
+                raise
+            print(f'deadlock in chunk {id_range}. retrying')
+            chunk_worker.db.rollback()
+    cursor.close()
+    return id_range
+
+
+class EnterpriseDumpReader:
+    """Reads the ndjson files of the dump from a directory or directly from the .tar.gz archive. The progress is
+    measured in the bytes read from the disk (compressed bytes for the archive), so no counting pass is needed."""
+
+    def __init__(self, dump_path, pigz=False, chunk_size=1024 * 1024):
+        self.dump_path = dump_path
+        self.pigz = pigz
+        self.chunk_size = chunk_size
+        if os.path.isdir(dump_path):
+            self.filepaths = sorted(glob.glob(os.path.join(dump_path, '*.ndjson')),
+                                    key=lambda fn: int(re.sub(r'[^0-9]', '', fn)))
+            # the offsets of the files in the concatenated dump
+            self.files_offsets = {}
+            self.total_bytes = 0
+            for filepath in self.filepaths:
+                self.files_offsets[os.path.basename(filepath)] = self.total_bytes
+                self.total_bytes += os.path.getsize(filepath)
+        else:
+            self.filepaths = None
+            self.total_bytes = os.path.getsize(dump_path)
+        self.bytes_read = 0
+        self.file = None
+
+    def read(self, size=-1):
+        """Read from the archive file counting the compressed bytes."""
+        data = self.file.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def progress(self, filename, position):
+        """Return the bytes of the dump read up to the position in the file."""
+        if self.filepaths is not None:
+            return self.files_offsets[filename] + position
+        return self.bytes_read
+
+    def skip(self, fp, size):
+        """Move the file position forward. The archive members are streamed, so the skipped bytes are read."""
+        if self.filepaths is not None:
+            fp.seek(size)
+        else:
+            while size > 0:
+                size -= len(fp.read(min(size, self.chunk_size)))
+
+    def files(self):
+        """Yield the names and the binary file objects of the ndjson files in the dump order."""
+        if self.filepaths is not None:
+            for filepath in self.filepaths:
+                with open(filepath, 'rb') as fp:
+                    yield os.path.basename(filepath), fp
+        else:
+            with open(self.dump_path, 'rb') as self.file:
+                if self.pigz:
+                    yield from self.archive_files_pigz()
+                else:
+                    with tarfile.open(fileobj=self, mode='r|gz') as archive:
+                        yield from self.archive_members(archive)
+
+    def archive_files_pigz(self):
+        # pigz decompresses in separate threads for reading, writing and checksums. the compressed data is fed
+        # through this process to count the progress
+        process = subprocess.Popen(['pigz', '-dc'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        def feed_pigz():
+            try:
+                for data in iter(partial(self.read, self.chunk_size), b''):
+                    process.stdin.write(data)
+                process.stdin.close()
+            except (BrokenPipeError, ValueError):  # pigz was stopped before the end of the archive
+                pass
+
+        feeder = threading.Thread(target=feed_pigz, daemon=True)
+        feeder.start()
+        try:
+            with tarfile.open(fileobj=process.stdout, mode='r|') as archive:
+                yield from self.archive_members(archive)
+        finally:
+            process.kill()
+            process.wait()
+
+    @staticmethod
+    def archive_members(archive):
+        for member in archive:
+            if member.isfile() and member.name.endswith('.ndjson'):
+                yield os.path.basename(member.name), archive.extractfile(member)
+
+
+def decode_article_json(dump_line):
+    article = json.loads(dump_line)
+    return {
+        'name': article['name'],
+        'redirects': [redirect['name'] for redirect in article.get('redirects', [])],
+        'html': article.get('article_body', {}).get('html'),
+    }
+
+
+def decode_article_orjson(dump_line):
+    article = orjson.loads(dump_line)
+    return {
+        'name': article['name'],
+        'redirects': [redirect['name'] for redirect in article.get('redirects', [])],
+        'html': article.get('article_body', {}).get('html'),
+    }
+
+
+simdjson_parsers = {}
+
+
+def decode_article_simdjson(dump_line):
+    # the document is parsed lazily, so only the used fields are converted into python objects. the parser is reused
+    # and it invalidates the previous document, so the fields are copied before the next line is parsed
+    if 'parser' not in simdjson_parsers:
+        simdjson_parsers['parser'] = simdjson.Parser()
+    article = simdjson_parsers['parser'].parse(dump_line)
+    try:
+        redirects = [redirect['name'] for redirect in article['redirects']]
+    except KeyError:
+        redirects = []
+    try:
+        html = article['article_body']['html']
+    except KeyError:
+        html = None
+    return {'name': article['name'], 'redirects': redirects, 'html': html}
+
+
+json_decoders = {
+    'simdjson': decode_article_simdjson,
+    'orjson': decode_article_orjson,
+    'json': decode_article_json,
+}
+
+
+def get_installed_json_decoders():
+    installed = {'simdjson': simdjson is not None, 'orjson': orjson is not None, 'json': True}
+    return [name for name in json_decoders if installed[name]]
+
+
+def get_article_decoder(name='auto'):
+    """Return the function decoding the dump line into the article's name, redirects' names and html. 'auto' selects
+    the fastest installed JSON library."""
+    if name == 'auto':
+        name = get_installed_json_decoders()[0]
+    if name not in get_installed_json_decoders():
+        raise ValueError(f'json decoder not installed: {name}')
+    return json_decoders[name]
+
+
+parser_worker = {}
+parse_chunk_size = 16
+
+
+def init_parser_worker(lang, title_maximum_length, line_content_maximum_length, label_maximum_length, json_decoder):
+    parser_worker['decode_article'] = get_article_decoder(json_decoder)
+    parser_worker['parser'] = WHParallelParser()
+    parser_worker['lang'] = lang
+    parser_worker['title_maximum_length'] = title_maximum_length
+    parser_worker['line_content_maximum_length'] = line_content_maximum_length
+    parser_worker['label_maximum_length'] = label_maximum_length
+
+
+def parse_article(dump_line):
+    """Parse the article from the dump line. Returns the article ready to be saved or None if the article is skipped.
+    Runs in the parser workers, so it does not touch the database."""
+    title_maximum_length = parser_worker['title_maximum_length']
+    line_content_maximum_length = parser_worker['line_content_maximum_length']
+    label_maximum_length = parser_worker['label_maximum_length']
+
+    article = parser_worker['decode_article'](dump_line)
+    title = article['name']
+    if len(title) > title_maximum_length:
+        print(f"title '{title[:title_maximum_length]}...' exceeds maximum length ({title_maximum_length})")
+        return None
+
+    # parse article before processing redirects
+    try:
+        article_parsed = parser_worker['parser'].parse_html(article['html'])
+    except Exception:
+        print(f'{title}: parser error')
+        return None
+
+    try:
+        caption = article_parsed.text[0]
+    except IndexError:
+        caption = None
+
+    wikipedia_decisions = defaultdict(list)
+    for tag in article_parsed.data:
+        if tag['tag'] == 'a' and 'rel' in tag['attrs'] and 'mw:WikiLink' in tag['attrs']['rel'] \
+                and 'title' in tag['attrs'] and ':' not in tag['attrs']['title']:  # filtrowanie tylko linków Wikipedii
+            if tag['start'][0] != tag['end'][0]:
+                print(f'{title}: multiline links not supported')
+                continue
+            line = tag['start'][0]
+            length = tag['end'][1] - tag['start'][1] + 1
+            link = {
+                'start': tag['start'][1],
+                'length': length,
+                'destination': tag['attrs']['title'],
+            }
+            link['label'] = article_parsed.text[line][link['start']:link['start'] + link['length']]
+            wikipedia_decisions[line].append(link)
+
+    lines = []
+    for line_nr, content in enumerate(article_parsed.text):
+        if len(content) > line_content_maximum_length:
+            print(
+                f"line {title}({line_nr}): '{content[:50]}...' exceeds maximum length ({line_content_maximum_length})")
+            continue
+        links = []
+        for link in wikipedia_decisions[line_nr]:
+            label = link['label']
+            if len(label) > label_maximum_length:
+                print(
+                    f"label {label} in {title}({line_nr}): '{label[:label_maximum_length]}...' "
+                    f"exceeds length ({label_maximum_length})")
+                continue
+            destination = link['destination']
+            if len(destination) > title_maximum_length:
+                print(f"destination: '{destination[:title_maximum_length]}...' "
+                      f"exceeds maximum length ({title_maximum_length})")
+                continue
+            links.append((link['start'], link['length'], label, destination))
+        lines.append((line_nr, content, pack_line_tokens(content, parser_worker['lang']), links))
+
+    return {'title': title, 'caption': caption, 'redirects': article['redirects'], 'lines': lines}
+
 
 @click.command('import-enterprise-dump')
 @click.argument('lang')
 @click.argument('dump_date')
-@click.argument('dump_path')
+@click.argument('dump_path')  # directory with the ndjson files or the .tar.gz archive
 @click.option('-e', '--early-stopping', type=int, default=-1, help='stop dump parsing after -e articles. -1 means no '
                                                                    'early stopping.')
 @click.option('-d', '--dump-id', type=int, default=-1, help='continue the import for a specified dump id')
 @click.option('-g', '--ground-truth-id', type=int, default=-1, help='continue the import for a specified ground truth')
 @click.option('-s', '--start-step', type=int, default=1, help='continue the import from a specified step')
+@click.option('-w', '--workers', type=int, default=1, help='number of processes parsing the articles in step 1')
+@click.option('-b', '--batch-size', type=int, default=1000, help='number of rows inserted at once in step 1')
+@click.option('-c', '--commit-interval', type=int, default=10000, help='number of rows inserted between commits in '
+                                                                       'step 1')
+@click.option('--fast-load/--no-fast-load', default=False, help='disable foreign key checks and drop the secondary '
+                                                                  'indexes for step 1. the indexes are rebuilt before '
+                                                                  'step 3. searching other dumps is slow meanwhile.')
+@click.option('--pigz/--no-pigz', default=False, help='decompress the .tar.gz dump with pigz')
+@click.option('-j', '--json-decoder', type=click.Choice(['auto'] + list(json_decoders)), default='auto',
+              help='library decoding the dump lines')
+@click.option('--chunk-size', type=int, default=100000, help='size of the id ranges processed at once in steps 3-7')
+@click.option('--chunk-workers', type=int, default=1, help='number of database connections processing the chunks of '
+                                                           'steps 3-7 in parallel')
 @with_appcontext
-def import_enterprise_dump_command(lang, dump_date, dump_path, early_stopping, dump_id, ground_truth_id, start_step):
-    filename_metadata = f'{lang}wiki-{dump_date}-enterprise-metadata.json'
-
-    homedir = os.path.expanduser("~/")
-    if homedir == "~/":
-        raise ValueError('could not find a default download directory')
-
-    download_dir = os.path.join(homedir, 'wikigold_data')
-    if not os.path.exists(download_dir):
-        os.mkdir(download_dir)
-
-    filepath_metadata = os.path.join(download_dir, filename_metadata)
-
+def import_enterprise_dump_command(lang, dump_date, dump_path, early_stopping, dump_id, ground_truth_id, start_step,
+                                   workers, batch_size, commit_interval, fast_load, pigz, json_decoder, chunk_size,
+                                   chunk_workers):
     db = get_db()
     cursor = db.cursor()
 
@@ -72,127 +432,86 @@ def import_enterprise_dump_command(lang, dump_date, dump_path, early_stopping, d
     def step_1():
         print(f'step 1. processing dump...')
 
-        dump_filepaths = sorted(glob.glob(os.path.join(dump_path, '*.ndjson')),
-                            key=lambda fn: int(re.sub(r'[^0-9]', '', fn)))
-        dump_filenames = [os.path.basename(filepath) for filepath in dump_filepaths]
-
-        if not os.path.exists(filepath_metadata):
-            print('collecting metadata ...')
-            articles_counter = {}
-            for filename in dump_filenames:
-                print(f'counting articles in {filename}...')
-                articles_counter[filename] = 0
-                filepath = os.path.join(dump_path, filename)
-                with open(filepath) as fp:
-                    for line in fp:
-                        articles_counter[filename] += 1
-
-            metadata = {'articles_counter': articles_counter}
-            with open(filepath_metadata, 'w') as file:
-                json.dump(metadata, file)
-            print('done')
+        if pigz and shutil.which('pigz') is None:
+            print('pigz not found. decompressing with the gzip module')
+        reader = EnterpriseDumpReader(dump_path, pigz=pigz and shutil.which('pigz') is not None)
+
+        def save_article(writer, article):
+            for redirect_name in article['redirects']:
+                writer.add_with_id('articles', {'title': redirect_name, 'caption': None,
+                                                'redirect_to_title': article['title'], 'dump_id': dump_id})
+
+            article_id = writer.add_with_id('articles', {'title': article['title'], 'caption': article['caption'],
+                                                         'redirect_to_title': None, 'dump_id': dump_id})
+
+            for line_nr, content, tokens, links in article['lines']:
+                line_id = writer.add_with_id('lines', {'article_id': article_id, 'nr': line_nr, 'content': content,
+                                                       'tokens': tokens})
+                for start, length, label, destination in links:
+                    writer.add('ground_truth_decisions', {'source_article_id': article_id, 'source_line_id': line_id,
+                                                          'start': start, 'length': length, 'label': label,
+                                                          'destination_title': destination,
+                                                          'ground_truth_id': ground_truth_id})
+
+        cursor.execute(sql_create_import_progress)
+        checkpoint = get_import_checkpoint(cursor, dump_id)
+        if checkpoint is not None:
+            checkpoint_filename, checkpoint_position, articles_processed = checkpoint
+            print(f'continuing from {checkpoint_filename} at byte {checkpoint_position} '
+                  f'({articles_processed} articles processed)')
         else:
-            print(f'loading metadata from: {filename_metadata}')
-            with open(filepath_metadata, 'r') as file:
-                metadata = json.load(file)
+            checkpoint_filename, checkpoint_position, articles_processed = None, 0, 0
 
-        sql_add_article = "INSERT INTO `articles` (`title`, `caption`, `dump_id`) VALUES (%s, %s, %s)"
-        sql_add_article_redirect = "INSERT INTO `articles` (`title`, `redirect_to_title`, `dump_id`) VALUES (%s, %s, %s)"
+        # the dump positions after the read articles in the dump order
+        dump_positions = deque()
 
-        sql_add_line = "INSERT INTO `lines` (`article_id`, `nr`, `content`) VALUES (%s, %s, %s)"
-        sql_add_ground_truth_decisions = '''INSERT INTO `ground_truth_decisions`
-        (`source_article_id`, `source_line_id`, `start`, `length`, `label`, `destination_title`, `ground_truth_id`) VALUES (%s, %s, %s, %s, %s, %s, %s)'''
-
-        parser = WHParallelParser()
+        def dump_lines():
+            skip_files = checkpoint_filename is not None
+            for filename, fp in reader.files():
+                position = 0
+                if skip_files:
+                    if filename != checkpoint_filename:
+                        continue
+                    skip_files = False
+                    reader.skip(fp, checkpoint_position)
+                    position = checkpoint_position
+                for line in fp:
+                    position += len(line)
+                    dump_positions.append((filename, position))
+                    yield line
 
-        def process_article(article):
-            title = article['name']
-            if len(title) > title_maximum_length:
-                print(f"title '{article[:title_maximum_length]}...' exceeds maximum length ({title_maximum_length})")
-                return
+        last_position = None
 
-            # parse article before processing redirects
-            try:
-                article_parsed = parser.parse_html(article['article_body']['html'])
-            except Exception:
-                print(f'{title}: parser error')
-                return
-
-            if 'redirects' in article:
-                for redirect in article['redirects']:
-                    data_article_redirect = (redirect['name'], article['name'], dump_id)
-                    cursor.execute(sql_add_article_redirect, data_article_redirect)
-
-            try:
-                caption = article_parsed.text[0]
-            except IndexError:
-                caption = None
-            data_article = (title, caption, dump_id)
-            cursor.execute(sql_add_article, data_article)
-            article_id = cursor.lastrowid
-
-            wikipedia_decisions = defaultdict(list)
-            for tag in article_parsed.data:
-                if tag['tag'] == 'a' and 'rel' in tag['attrs'] and 'mw:WikiLink' in tag['attrs']['rel'] \
-                        and 'title' in tag['attrs'] and ':' not in tag['attrs']['title']:  # filtrowanie tylko linków Wikipedii
-                    if tag['start'][0] != tag['end'][0]:
-                        print(f'{title}: multiline links not supported')
-                        continue
-                    line = tag['start'][0]
-                    length = tag['end'][1] - tag['start'][1] + 1
-                    link = {
-                        'start': tag['start'][1],
-                        'length': length,
-                        'destination': tag['attrs']['title'],
-                    }
-                    link['label'] = article_parsed.text[line][link['start']:link['start'] + link['length']]
-                    wikipedia_decisions[line].append(link)
-
-            for line_nr, content in enumerate(article_parsed.text):
-                if len(content) > line_content_maximum_length:
-                    print(
-                        f"line {article['name']}({line_nr}): '{content[:50]}...' exceeds maximum length ({line_content_maximum_length})")
-                    continue
-                data_line = (article_id, line_nr, content)
-                cursor.execute(sql_add_line, data_line)
-                line_id = cursor.lastrowid
-                if line_nr in wikipedia_decisions:
-                    for link in wikipedia_decisions[line_nr]:
-                        label = link['label']
-                        if len(label) > label_maximum_length:
-                            print(
-                                f"label {label} in {article['name']}({line_nr}): '{label[:label_maximum_length]}...' "
-                                f"exceeds length ({label_maximum_length})")
-                            continue
-                        destination = link['destination']
-                        if len(destination) > title_maximum_length:
-                            print(f"destination: '{destination[:title_maximum_length]}...' "
-                                  f"exceeds maximum length ({title_maximum_length})")
-                            continue
-
-                        data_ground_truth_decision = (
-                            article_id, line_id, link['start'], link['length'], label, destination, ground_truth_id)
-                        cursor.execute(sql_add_ground_truth_decisions, data_ground_truth_decision)
-            db.commit()  # commit after each article
+        def save_checkpoint(writer_cursor):
+            if last_position is not None:
+                filename, position = last_position
+                set_import_checkpoint(writer_cursor, dump_id, filename, position, articles_processed)
 
         # main article processing loop
-        articles_processed = 0
-        stop_processing = False
-        total_articles = sum(metadata['articles_counter'].values())
-        with tqdm(total=total_articles) as pbar:
-            for filename in dump_filenames:
-                filepath = os.path.join(dump_path, filename)
-                with open(filepath) as fp:
-                    for line in fp:
-                        article = json.loads(line)
-                        process_article(article)
-                        pbar.update(1)
+        parser_initargs = (lang, title_maximum_length, line_content_maximum_length, label_maximum_length, json_decoder)
+        # the dump is read in the pipeline's reader thread, the articles are parsed in the workers and saved here.
+        # the pipeline keeps the dump order, so the articles get the same ids as in the sequential import
+        pipeline = Pipeline(dump_lines(), parse_article, workers, initializer=init_parser_worker,
+                            initargs=parser_initargs, chunk_size=parse_chunk_size)
+        articles = iter(pipeline)
+        with tqdm(total=reader.total_bytes, unit='B', unit_scale=True, unit_divisor=1024) as pbar:
+            try:
+                with BulkWriter(db, batch_size, commit_interval, on_commit=save_checkpoint) as writer:
+                    for article in articles:
+                        if article is not None:
+                            save_article(writer, article)
+                        last_position = dump_positions.popleft()
                         articles_processed += 1
+                        writer.commit_if_due()  # the checkpoint is committed together with the articles
+                        pbar.set_postfix(articles=articles_processed, **pipeline.stats(), refresh=False)
+                        pbar.update(reader.progress(*last_position) - pbar.n)
                         if early_stopping != -1 and articles_processed >= early_stopping:
-                            stop_processing = True
                             break
-                if stop_processing:
-                    break
+            finally:
+                articles.close()  # stops the reader and the workers
+
+        delete_import_progress(cursor, dump_id, 1)
+        db.commit()
 
     def step_2():
         print('step 2. saving labels...', end=' ')
@@ -205,69 +524,130 @@ def import_enterprise_dump_command(lang, dump_date, dump_path, early_stopping, d
         print(f'{elapsed:.2f} s')
 
     def step_3():
-        print('step 3. updating ground_truth_decisions destination_ids...', end=' ')
+        print('step 3. updating ground_truth_decisions destination_ids...')
         start = time.time_ns()
+        sql_range = 'SELECT MIN(`id`), MAX(`id`) FROM `ground_truth_decisions` WHERE `ground_truth_id`=%s'
         sql_update_ground_truth_decisions= '''
-        UPDATE `ground_truth_decisions` INNER JOIN `articles` ON `ground_truth_decisions`.`destination_title`=`articles`.`title`
+        UPDATE `ground_truth_decisions` INNER JOIN `articles`
+            ON `ground_truth_decisions`.`destination_title_hash`=`articles`.`title_hash`
+                AND `ground_truth_decisions`.`destination_title`=`articles`.`title`
             SET `ground_truth_decisions`.`destination_article_id` = `articles`.`id`
-            WHERE `ground_truth_decisions`.`ground_truth_id`=%s AND `articles`.`dump_id`=%s'''
-        cursor.execute(sql_update_ground_truth_decisions, (ground_truth_id, dump_id))
-        db.commit()
+            WHERE `ground_truth_decisions`.`ground_truth_id`=%s AND `articles`.`dump_id`=%s
+                AND `ground_truth_decisions`.`id` BETWEEN %s AND %s'''
+        run_chunked_step(3, sql_range, (ground_truth_id,),
+                         [(sql_update_ground_truth_decisions, (ground_truth_id, dump_id))])
         elapsed = (time.time_ns() - start) / 1e9
         print(f'{elapsed:.2f} s')
 
     def step_4():
-        print('step 4. updating ground_truth_decisions label_ids...', end=' ')
+        print('step 4. updating ground_truth_decisions label_ids...')
         start = time.time_ns()
+        sql_range = 'SELECT MIN(`id`), MAX(`id`) FROM `ground_truth_decisions` WHERE `ground_truth_id`=%s'
         sql_update_ground_truth_decisions = '''
-            UPDATE `ground_truth_decisions` INNER JOIN `labels` ON `ground_truth_decisions`.`label`=`labels`.`label`
+            UPDATE `ground_truth_decisions` INNER JOIN `labels`
+                ON `ground_truth_decisions`.`label_hash`=`labels`.`label_hash`
+                    AND `ground_truth_decisions`.`label`=`labels`.`label`
                 SET `ground_truth_decisions`.`label_id` = `labels`.`id`
-                WHERE `ground_truth_decisions`.`ground_truth_id`=%s AND `labels`.`dump_id`=%s'''
-        cursor.execute(sql_update_ground_truth_decisions, (ground_truth_id, dump_id))
-        db.commit()
+                WHERE `ground_truth_decisions`.`ground_truth_id`=%s AND `labels`.`dump_id`=%s
+                    AND `ground_truth_decisions`.`id` BETWEEN %s AND %s'''
+        run_chunked_step(4, sql_range, (ground_truth_id,),
+                         [(sql_update_ground_truth_decisions, (ground_truth_id, dump_id))])
         elapsed = (time.time_ns() - start) / 1e9
         print(f'{elapsed:.2f} s')
 
     def step_5():
-        print('step 5. updating articles redirects...', end=' ')
+        print('step 5. updating articles redirects...')
         start = time.time_ns()
+        sql_range = 'SELECT MIN(`id`), MAX(`id`) FROM `articles` WHERE `dump_id`=%s'
         sql_update_article_redirect = '''
-        UPDATE `articles` `a1` INNER JOIN `articles` `a2` ON `a1`.`redirect_to_title`=`a2`.`title`
+        UPDATE `articles` `a1` INNER JOIN `articles` `a2`
+            ON `a1`.`redirect_to_title_hash`=`a2`.`title_hash` AND `a1`.`redirect_to_title`=`a2`.`title`
             SET `a1`.`caption`=`a2`.`caption`, `a1`.`redirect_to_id`=`a2`.`id`
-            WHERE `a1`.`dump_id`=%s AND `a2`.`dump_id`=%s'''
-        data_article_redirect = (dump_id, dump_id)
-        cursor.execute(sql_update_article_redirect, data_article_redirect)
-        db.commit()
+            WHERE `a1`.`dump_id`=%s AND `a2`.`dump_id`=%s AND `a1`.`id` BETWEEN %s AND %s'''
+        run_chunked_step(5, sql_range, (dump_id,), [(sql_update_article_redirect, (dump_id, dump_id))])
         elapsed = (time.time_ns() - start) / 1e9
         print(f'{elapsed:.2f} s')
 
     def step_6():
-        print('step 6. updating articles counters...', end=' ')
+        print('step 6. updating articles counters...')
         start = time.time_ns()
+        # the destination ids are set in step 3, so the chunks are ranges of the articles' ids
+        sql_range = 'SELECT MIN(`id`), MAX(`id`) FROM `articles` WHERE `dump_id`=%s'
         sql_update_article_counter = '''UPDATE `articles` INNER JOIN
-                                            (SELECT `destination_title`, COUNT(*) AS `counter` FROM `ground_truth_decisions`
-                                                WHERE `ground_truth_id`=%s GROUP BY `destination_title`) `wd1`
-                                            ON `articles`.`title`=`wd1`.`destination_title`
-                                            SET `articles`.`counter`=`wd1`.`counter`
-                                            WHERE `articles`.`dump_id`=%s'''
-        cursor.execute(sql_update_article_counter, (ground_truth_id, dump_id))
-        db.commit()
+                                            (SELECT `destination_article_id`, COUNT(*) AS `counter` FROM `ground_truth_decisions`
+                                                WHERE `ground_truth_id`=%s AND `destination_article_id` BETWEEN %s AND %s
+                                                GROUP BY `destination_article_id`) `wd1`
+                                            ON `articles`.`id`=`wd1`.`destination_article_id`
+                                            SET `articles`.`counter`=`wd1`.`counter`'''
+        run_chunked_step(6, sql_range, (dump_id,), [(sql_update_article_counter, (ground_truth_id,))])
         elapsed = (time.time_ns() - start) / 1e9
         print(f'{elapsed:.2f} s')
 
     def step_7():
-        print('step 7. saving labels_articles...', end=' ')
+        print('step 7. saving labels_articles...')
         start = time.time_ns()
+        sql_range = 'SELECT MIN(`label_id`), MAX(`label_id`) FROM `ground_truth_decisions` WHERE `ground_truth_id`=%s'
+        # remove the labels_articles of a chunk interrupted after the commit, so the chunk can be repeated
+        sql_delete_labels_articles = 'DELETE FROM `labels_articles` WHERE `label_id` BETWEEN %s AND %s'
         sql_create_labels_articles = '''INSERT INTO `labels_articles` (`label_id`, `title`, `article_id`, `counter`)
                                 SELECT `wd`.`label_id`, `wd`.`destination_title`, `wd`.`destination_article_id`, COUNT(*)
                                     FROM `ground_truth_decisions` `wd`
-                                    WHERE `wd`.`ground_truth_id`=%s
+                                    WHERE `wd`.`ground_truth_id`=%s AND `wd`.`label_id` BETWEEN %s AND %s
                                     GROUP BY `wd`.`label_id`, `wd`.`destination_title`, `wd`.`destination_article_id`'''
-        cursor.execute(sql_create_labels_articles, (ground_truth_id,))
-        db.commit()
+        run_chunked_step(7, sql_range, (ground_truth_id,),
+                         [(sql_delete_labels_articles, ()), (sql_create_labels_articles, (ground_truth_id,))])
         elapsed = (time.time_ns() - start) / 1e9
         print(f'{elapsed:.2f} s')
 
+    def run_chunked_step(step, sql_range, range_params, statements):
+        """Run the statements for the consecutive id ranges. Each statement gets the first and the last id of the chunk
+        as its last parameters. The last id of the finished chunks is saved in import_progress, so the step continues
+        from the next chunk when it is started again."""
+        cursor.execute(sql_create_import_progress)
+        cursor.execute(sql_range, range_params)
+        first_id, last_id = cursor.fetchone()
+        if first_id is None:
+            return
+
+        position = get_import_progress(cursor, dump_id, step)
+        if position is not None:
+            print(f'continuing from id: {position + 1}')
+            first_id = position + 1
+        id_ranges = [(chunk_first_id, min(chunk_first_id + chunk_size - 1, last_id))
+                     for chunk_first_id in range(first_id, last_id + 1, chunk_size)]
+
+        with tqdm(total=len(id_ranges)) as pbar:
+            if chunk_workers > 1:
+                # the chunks finish out of order. the progress is the last id before the first unfinished chunk
+                finished_ranges = set()
+                pending_ranges = iter(id_ranges)
+                next_range = next(pending_ranges, None)  # no ranges are left if the step finished before a crash
+                init_args = (current_app._get_current_object(), statements, fast_load)
+                try:
+                    with multiprocessing.pool.ThreadPool(chunk_workers, initializer=init_chunk_worker,
+                                                         initargs=init_args) as pool:
+                        for id_range in pool.imap_unordered(run_chunk, id_ranges):
+                            finished_ranges.add(id_range)
+                            while next_range in finished_ranges:
+                                set_import_progress(cursor, dump_id, step, next_range[1])
+                                next_range = next(pending_ranges, None)
+                            db.commit()
+                            pbar.update(1)
+                finally:
+                    for connection in pool_connections.values():
+                        connection.close()
+                    pool_connections.clear()
+            else:
+                for chunk_first_id, chunk_last_id in id_ranges:
+                    for sql, params in statements:
+                        cursor.execute(sql, params + (chunk_first_id, chunk_last_id))
+                    set_import_progress(cursor, dump_id, step, chunk_last_id)
+                    db.commit()  # commit the chunk together with the progress
+                    pbar.update(1)
+
+        delete_import_progress(cursor, dump_id, step)
+        db.commit()
+
     def step_8():
         print('step 8. save articles count...', end=' ')
         start = time.time_ns()
@@ -279,12 +659,61 @@ def import_enterprise_dump_command(lang, dump_date, dump_path, early_stopping, d
         elapsed = (time.time_ns() - start) / 1e9
         print(f'{elapsed:.2f} s')
 
+    steps_functions = locals()
+    steps = {step: steps_functions[f'step_{step}'] for step in range(start_step, 9)}
+    phases_elapsed = {}
+
+    def run_phase(name, phase):
+        start = time.time_ns()
+        phase()
+        phases_elapsed[name] = (time.time_ns() - start) / 1e9
+
+    check_title_hash_columns(cursor)
+    if fast_load:
+        cursor.execute(sql_disable_checks)
+        if 1 in steps:
+            run_phase('drop indexes', lambda: drop_import_indexes(cursor))
+
     # apply selected steps
-    for step in range(start_step, 9):
-        locals()[f'step_{step}']()
+    for step, step_function in steps.items():
+        # the steps from 3 on join on the indexed columns. the indexes are created also when the fast load dropping
+        # them was interrupted and the import is continued without --fast-load
+        if step == max(start_step, 3):
+            run_phase('create indexes', lambda: create_import_indexes(cursor))
+        run_phase(f'step {step}', step_function)
+
+    if fast_load:
+        cursor.execute(sql_enable_checks)
+
+    print('time spent in each phase:')
+    for name, elapsed in phases_elapsed.items():
+        print(f'{name}: {elapsed:.2f} s')
 
     cursor.close()
 
 
+@click.command('benchmark-json-decoders')
+@click.argument('sample_path')
+@click.option('-n', '--lines-limit', type=int, default=1000, help='number of the dump lines decoded')
+def benchmark_json_decoders_command(sample_path, lines_limit):
+    """Compare the decoding time of the installed JSON decoders on the lines of the ndjson sample."""
+    with open(sample_path, 'rb') as fp:
+        dump_lines = [line for line, _ in zip(fp, range(lines_limit))]
+    sample_size = sum(len(line) for line in dump_lines)
+    print(f'lines: {len(dump_lines)} size: {sample_size / 1024 / 1024:.2f} MiB')
+
+    for name in json_decoders:
+        if name not in get_installed_json_decoders():
+            print(f'{name}: not installed')
+            continue
+        decode_article = get_article_decoder(name)
+        start = time.time_ns()
+        for dump_line in dump_lines:
+            decode_article(dump_line)
+        elapsed = (time.time_ns() - start) / 1e9
+        print(f'{name}: {elapsed:.3f} s ({sample_size / 1024 / 1024 / elapsed:.2f} MiB/s)')
+
+
 def init_app(app):
     app.cli.add_command(import_enterprise_dump_command)
+    app.cli.add_command(benchmark_json_decoders_command)
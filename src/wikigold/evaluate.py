@@ -2,26 +2,34 @@ import click
 from flask.cli import with_appcontext
 
 
-def ground_truth_resolve_redirects(ground_truth_decisions):
+def ground_truth_resolve_redirects(ground_truth_decisions, knowledge_base_id):
     from .db import get_db
+    from .redirects import get_redirects
+
+    decisions = [ground_truth_decision for ground_truth_decision in ground_truth_decisions
+                 if ground_truth_decision['destination_article_id'] is not None]
+    if len(decisions) == 0:
+        return ground_truth_decisions
+
+    redirects = get_redirects(knowledge_base_id)
+    ids = redirects.resolve([decision['destination_article_id'] for decision in decisions]).tolist()
+
+    # the titles of the redirects' targets are selected in a single query
+    redirected_ids = {id for id, decision in zip(ids, decisions) if id != decision['destination_article_id']}
+    titles = {}
+    if len(redirected_ids) > 0:
+        db = get_db()
+        cursor = db.cursor(dictionary=True)
+        ids_str = ','.join(map(str, redirected_ids))
+        sql = f'SELECT `id`, `title` FROM `articles` WHERE `id` IN ({ids_str})'
+        cursor.execute(sql)
+        titles = {row['id']: row['title'] for row in cursor}
+        cursor.close()
 
-    db = get_db()
-    cursor = db.cursor(dictionary=True)
-
-    for ground_truth_decision in ground_truth_decisions:
-        id = ground_truth_decision['destination_article_id']
-        title = ground_truth_decision['destination_title']
-        while True:
-            sql = 'SELECT `redirect_to_id`, `redirect_to_title` FROM `articles` WHERE `id`=%s'
-            data = (id, )
-            cursor.execute(sql, data)
-            result = cursor.fetchone()
-            if result['redirect_to_id'] is None:
-                break
-            id = result['redirect_to_id']
-            title = result['redirect_to_title']
-        ground_truth_decision['destination_article_id'] = id
-        ground_truth_decision['destination_title'] = title
+    for id, decision in zip(ids, decisions):
+        if id in titles:
+            decision['destination_article_id'] = id
+            decision['destination_title'] = titles[id]
 
     return ground_truth_decisions
 
@@ -51,7 +59,7 @@ def evaluate(evaluate_config_path, individual, unknown_labels, disambiguation_er
 
     if 'ground_truth_name' in run_config['ground_truth']:
         ground_truth_name = run_config['ground_truth']['ground_truth_name']
-        sql = 'SELECT `id` FROM `ground_truth` WHERE `name`=%s'
+        sql = 'SELECT `id`, `knowledge_base_id` FROM `ground_truth` WHERE `name`=%s'
         data = (ground_truth_name,)
         cursor.execute(sql, data)
         results = cursor.fetchall()
@@ -60,6 +68,7 @@ def evaluate(evaluate_config_path, individual, unknown_labels, disambiguation_er
         elif len(results) > 1:
             raise Exception(f'ground truth name "{ground_truth_name}" ambiguous')
         ground_truth_id = results[0]['id']
+        knowledge_base_id = results[0]['knowledge_base_id']
     else:
         raise Exception('cannot find specified ground truth')
 
@@ -109,7 +118,7 @@ def evaluate(evaluate_config_path, individual, unknown_labels, disambiguation_er
 
         ground_truth_decisions = get_ground_truth_decisions(article['id'], ground_truth_id)
         if resolve_redirects:
-            ground_truth_resolve_redirects(ground_truth_decisions)
+            ground_truth_resolve_redirects(ground_truth_decisions, knowledge_base_id)
         ground_truth_decisions_ids = {ground_truth_decision['destination_article_id']
                                       for ground_truth_decision in ground_truth_decisions
                                       if 'destination_article_id' in ground_truth_decision}
@@ -1,11 +1,13 @@
+import contextlib
 import json
+import os.path
+import struct
 from urllib.parse import urljoin
 
 from flask import g, current_app, url_for
-from nltk import TreebankWordTokenizer
-from nltk.data import load
 
 from .db import get_db
+from .tokenizers import get_tokenizer, tokenize_lines
 
 
 def absolute_url_for(endpoint, **values):
@@ -17,41 +19,95 @@ def absolute_url_for(endpoint, **values):
     return url
 
 
+def get_data_dir():
+    """Return the directory for downloaded dumps and other files generated by the commands."""
+    homedir = os.path.expanduser("~/")
+    if homedir == "~/":
+        raise ValueError('could not find a default download directory')
+
+    data_dir = os.path.join(homedir, 'wikigold_data')
+    if not os.path.exists(data_dir):
+        os.mkdir(data_dir)
+
+    return data_dir
+
+
+@contextlib.contextmanager
+def open_for_replace(path):
+    """Open a temporary file which replaces the file at path when it is written completely. The files memory-mapped
+    by the running workers are never truncated, the workers keep the old file until they map it again."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        yield file
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
 def word_tokenize_spans(text, language="english"):
-    sent_tokenizer = load(f'tokenizers/punkt/{language}.pickle')
-    word_tokenizer = TreebankWordTokenizer()
+    return get_tokenizer(language).span_tokenize(text)
 
-    sentence_spans = sent_tokenizer.span_tokenize(text)
-    for (sentence_span_start, sentence_span_end) in sentence_spans:
-        sentence = text[sentence_span_start:sentence_span_end]
-        word_spans = word_tokenizer.span_tokenize(sentence)
-        for (token_span_start, token_span_end) in word_spans:
-            yield sentence_span_start + token_span_start, sentence_span_start + token_span_end
+
+span_struct = struct.Struct('<II')
+
+
+def pack_spans(spans):
+    """Pack (start, end) token spans into a blob of little-endian uint32 pairs."""
+    offsets = [offset for span in spans for offset in span]
+    return struct.pack(f'<{len(offsets)}I', *offsets)
+
+
+def unpack_spans(blob):
+    """Inverse of pack_spans. Returns the list of (start, end) tuples."""
+    return list(span_struct.iter_unpack(blob))
+
+
+def pack_line_tokens(content, lang='en'):
+    """Tokenize the line content for the `lines`.`tokens` column. Returns None when the line cannot be tokenized."""
+    try:
+        return pack_spans(get_tokenizer(lang).span_tokenize(content))
+    except ValueError:
+        return None
+
+
+def get_article_lang(article_id):
+    db = get_db()
+    cursor = db.cursor(dictionary=True)
+    sql = '''SELECT `dumps`.`lang` FROM `articles` JOIN `dumps` ON `articles`.`dump_id`=`dumps`.`id`
+                WHERE `articles`.`id`=%s'''
+    cursor.execute(sql, (article_id,))
+    row = cursor.fetchone()
+    cursor.close()
+    return row['lang'] if row is not None else 'en'
 
 
 def get_lines(article_id, limit=None):
     db = get_db()
     cursor = db.cursor(dictionary=True)
-    sql = "SELECT `id`, `content` FROM `lines` WHERE `article_id`=%s ORDER BY `nr`"
+    sql = "SELECT `id`, `content`, `tokens` FROM `lines` WHERE `article_id`=%s ORDER BY `nr`"
     if limit:
         sql += f" LIMIT {limit}"
 
     data = (article_id,)
     cursor.execute(sql, data)
+    rows = cursor.fetchall()
+    cursor.close()
 
     lines = []
-    try:
-        for row in cursor:
-            line_text = row['content'].decode('utf-8')
-            line_tokens = []
-            for (token_span_start, token_span_end) in word_tokenize_spans(line_text):
-                line_tokens.append((token_span_start, token_span_end))
-            lines.append({'content': line_text, 'tokens': line_tokens})
-    except ValueError:
-        cursor.reset()
-        raise
-    finally:
-        cursor.close()
+    untokenized_lines = []
+    for row in rows:
+        line = {'content': row['content'].decode('utf-8')}
+        if row['tokens'] is not None:  # tokenized during the import
+            line['tokens'] = unpack_spans(row['tokens'])
+        else:
+            untokenized_lines.append(line)
+        lines.append(line)
+
+    if len(untokenized_lines) > 0:
+        lines_tokens = tokenize_lines([line['content'] for line in untokenized_lines],
+                                      get_article_lang(article_id))  # raises ValueError
+        for line, line_tokens in zip(untokenized_lines, lines_tokens):
+            line['tokens'] = line_tokens
 
     return lines
 
@@ -201,11 +257,13 @@ def normalize_algorithm_json(algorithm):
 
 
 def wikification(lines, algorithm_normalized_json):
-    from .retrieval import get_labels_exact, resolve_overlap_longest
+    from .retrieval import get_labels_exact, get_labels_trie, resolve_overlap_longest
     from .disambiguation import rate_by, rate_by_relatedness, resolve_overlap_best_match
 
     if algorithm_normalized_json['retrieval'] == 'exact':
         labels = get_labels_exact(lines, algorithm_normalized_json)
+    elif algorithm_normalized_json['retrieval'] == 'trie':
+        labels = get_labels_trie(lines, algorithm_normalized_json)
     else:
         raise Exception("unknown retrieval algorithm")
 
@@ -0,0 +1,139 @@
+"""
+Read-only label index stored in a single file and memory-mapped by the web workers.
+
+The index is an alternative labels backend to redis (LABELS_BACKEND=mmap). It is a snapshot of the labels cached in
+redis (see cache-labels), so it holds the labels of the dump cached there and is rebuilt with build-label-index after
+the cache changes. Since the file is mapped read-only, all the gunicorn workers share its pages through the OS page
+cache.
+
+File layout:
+1. header: magic, format version, number of buckets
+2. buckets: open addressing hash table (linear probing) of uint64 record offsets increased by one (0 is an empty bucket)
+3. records: key length (uint16), value length (uint32), utf-8 encoded label, label encoded with cache.encode_label
+"""
+
+import hashlib
+import mmap
+import os.path
+import struct
+
+import click
+import numpy as np
+from flask import current_app
+from flask.cli import with_appcontext
+from tqdm import tqdm
+
+from .helper import get_data_dir, open_for_replace
+
+index_magic = b'WGLI'
+index_format_version = 1
+
+# magic, version, buckets count
+header_struct = struct.Struct('<4sIQ')
+bucket_struct = struct.Struct('<Q')
+# key length, value length
+record_header_struct = struct.Struct('<HI')
+
+label_indexes = {}
+
+
+def hash_key(key):
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+def get_label_index_path():
+    if current_app.config['LABEL_INDEX_PATH'] != '':
+        return current_app.config['LABEL_INDEX_PATH']
+    return os.path.join(get_data_dir(), 'labels-index.bin')
+
+
+class LabelIndex:
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self.mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.buckets_count = header_struct.unpack_from(self.mm)
+        if magic != index_magic or version != index_format_version:
+            raise ValueError(f'unsupported label index: {path}')
+        self.buckets_offset = header_struct.size
+
+    def get(self, label_name):
+        """Return the encoded label or None if the label is not in the index."""
+        key = label_name.encode('utf-8')
+        mm = self.mm
+        bucket = hash_key(key) % self.buckets_count
+        while True:
+            record_offset, = bucket_struct.unpack_from(mm, self.buckets_offset + bucket * bucket_struct.size)
+            if record_offset == 0:
+                return None
+            record_offset -= 1
+            key_length, value_length = record_header_struct.unpack_from(mm, record_offset)
+            key_offset = record_offset + record_header_struct.size
+            if mm[key_offset:key_offset + key_length] == key:
+                value_offset = key_offset + key_length
+                return mm[value_offset:value_offset + value_length]
+            bucket = (bucket + 1) % self.buckets_count
+
+    def mget(self, label_names):
+        return [self.get(label_name) for label_name in label_names]
+
+
+def get_label_index():
+    """Return the label index. The index is mapped once per process."""
+    path = get_label_index_path()
+    if path not in label_indexes:
+        if not os.path.exists(path):
+            raise Exception(f'label index {path} not found. run build-label-index first')
+        label_indexes[path] = LabelIndex(path)
+    return label_indexes[path]
+
+
+def write_label_index(path, labels, labels_count):
+    """Write the index of (label name, encoded label) pairs. labels_count is the upper bound of the labels number."""
+    buckets_count = max(2 * labels_count, 1)  # load factor <= 0.5
+    buckets = np.zeros(buckets_count, dtype='<u8')
+
+    with open_for_replace(path) as file:  # the workers may have the index mapped
+        file.write(header_struct.pack(index_magic, index_format_version, buckets_count))
+        file.seek(header_struct.size + buckets_count * bucket_struct.size)  # records start after the buckets
+        for label_name, label in labels:
+            key = label_name.encode('utf-8')
+            bucket = hash_key(key) % buckets_count
+            while buckets[bucket] != 0:
+                bucket = (bucket + 1) % buckets_count
+            buckets[bucket] = file.tell() + 1
+            file.write(record_header_struct.pack(len(key), len(label)))
+            file.write(key)
+            file.write(label)
+
+        file.seek(header_struct.size)
+        file.write(buckets.tobytes())
+
+
+@click.command('build-label-index')
+@with_appcontext
+def build_label_index_command():
+    """Write the labels cached in redis into the label index file. The index mirrors the current labels cache."""
+    from .cache import chunks, decode_label, encode_label, get_redis, label_format_version
+
+    r = get_redis('labels')
+    labels_count = r.dbsize()
+    print(f'labels count: {labels_count}')
+
+    def cached_labels():
+        with tqdm(total=labels_count) as pbar:
+            for label_names in chunks(r.scan_iter(count=current_app.config['REDIS_CHUNK_SIZE'])):
+                for label_name, label in zip(label_names, r.mget(label_names)):
+                    if label is not None:
+                        if label[0] != label_format_version:  # not migrated cache
+                            label = encode_label(decode_label(label))
+                        yield label_name.decode('utf-8'), label
+                pbar.update(len(label_names))
+
+    path = get_label_index_path()
+    print(f'saving label index to: {path}')
+    write_label_index(path, cached_labels(), labels_count)
+
+
+def init_app(app):
+    app.cli.add_command(build_label_index_command)
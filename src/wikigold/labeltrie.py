@@ -0,0 +1,184 @@
+"""
+Token-level trie of all labels of a dump used by the "trie" retrieval.
+
+The trie is built once with the build-label-trie command and stored in the data directory. Instead of the nodes it
+keeps two sorted arrays of 64-bit hashes: the hashes of all the token prefixes of the labels (the trie's nodes) and the
+hashes of the labels. The file is memory-mapped, so all the gunicorn and pool workers share its pages through the OS
+page cache. Matching walks the prefixes from every token of a line and stops as soon as the continuation is not
+a label prefix. MAX_NGRAMS is only a soft limit (see match_labels), so the labels longer than MAX_NGRAMS are found too.
+
+The labels are tokenized out of context with the tokenizer of the dump's language, while the lines are tokenized
+whole (sentences first, then words). A label whose tokens differ in a line (e.g. a trailing period merged with the last
+word at the end of a sentence) is not matched there. The found labels are compared by their surface string in the
+line, so a label is never matched by different text.
+
+File layout:
+1. header: magic, format version, tokens count of the longest label, number of the prefixes, number of the labels
+2. uint64 sorted hashes of the prefixes (tokens joined with the unit separator)
+3. uint64 sorted hashes of the labels
+"""
+
+import mmap
+import os.path
+import struct
+from array import array
+
+import click
+import numpy as np
+from flask import current_app
+from flask.cli import with_appcontext
+from tqdm import tqdm
+
+from .db import get_db
+from .helper import get_data_dir, open_for_replace
+from .labelindex import hash_key
+from .tokenizers import get_tokenizer
+
+trie_magic = b'WGLT'
+trie_format_version = 1
+
+# magic, version, max label tokens, prefixes count, labels count
+header_struct = struct.Struct('<4sIQQQ')
+
+# joins the tokens of a prefix, so the prefixes of different token sequences never have the same key
+tokens_separator = '\x1f'
+
+label_tries = {}
+
+
+def get_label_trie_path(dump_id):
+    return os.path.join(get_data_dir(), f'labels-trie-{dump_id}.bin')
+
+
+def prefix_key(tokens):
+    return tokens_separator.join(tokens).encode('utf-8')
+
+
+class LabelTrie:
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self.mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.max_tokens, prefixes_count, labels_count = header_struct.unpack_from(self.mm)
+        if magic != trie_magic or version != trie_format_version:
+            raise ValueError(f'unsupported label trie: {path}')
+        self.prefixes = np.frombuffer(self.mm, dtype='<u8', count=prefixes_count, offset=header_struct.size)
+        self.labels = np.frombuffer(self.mm, dtype='<u8', count=labels_count,
+                                    offset=header_struct.size + self.prefixes.nbytes)
+
+    @staticmethod
+    def contains(hashes, key):
+        key_hash = hash_key(key)
+        position = np.searchsorted(hashes, key_hash)
+        return position < len(hashes) and hashes[position] == key_hash
+
+    def is_prefix(self, tokens):
+        return self.contains(self.prefixes, prefix_key(tokens))
+
+    def is_label(self, label_name):
+        return self.contains(self.labels, label_name.encode('utf-8'))
+
+
+def get_label_trie(dump_id=None):
+    """Return the labels' trie of the dump. The trie is mapped once per process."""
+    if dump_id is None:
+        dump_id = current_app.config['KNOWLEDGE_BASE']
+
+    if dump_id not in label_tries:
+        trie_path = get_label_trie_path(dump_id)
+        if not os.path.exists(trie_path):
+            raise Exception(f'labels trie for dump {dump_id} not found. run build-label-trie first')
+        label_tries[dump_id] = LabelTrie(trie_path)
+
+    return label_tries[dump_id]
+
+
+def match_labels(lines, trie, max_ngrams):
+    """Yield the n-grams of the lines which are labels in the trie. The n-grams have the same structure as the ones
+    returned by `helper.ngrams`.
+
+    max_ngrams is a soft limit: the walk from a token is bounded only by the longest label and stops when the n-gram is
+    not a label prefix. All the labels of at most max_ngrams tokens are yielded, of the longer ones only the longest
+    label of the walk, so long labels are found without multiplying the candidates."""
+    for line_nr, line in enumerate(lines):
+        line_content = line['content']
+        line_tokens = line['tokens']
+        tokens = [line_content[token_start:token_end] for token_start, token_end in line_tokens]
+        for token_nr in range(len(tokens)):
+            longest_label = None
+            for last_token_nr in range(token_nr, min(token_nr + trie.max_tokens, len(tokens))):
+                if not trie.is_prefix(tokens[token_nr:last_token_nr + 1]):  # no label starts with this n-gram
+                    break
+                label_start = line_tokens[token_nr][0]  # begin of the first gram
+                label_end = line_tokens[last_token_nr][1]  # end of the last gram
+                label = line_content[label_start:label_end]
+                if trie.is_label(label):
+                    candidate_label = {
+                        'name': label,
+                        'line': line_nr,
+                        'start': token_nr,
+                        'ngrams': last_token_nr - token_nr + 1,
+                    }
+                    if candidate_label['ngrams'] <= max_ngrams:
+                        yield candidate_label
+                    else:
+                        longest_label = candidate_label
+            if longest_label is not None:
+                yield longest_label
+
+
+def write_label_trie(path, prefixes, labels, max_tokens):
+    """Write the hashes of the prefixes and the labels (arrays of uint64). The hashes are sorted and deduplicated."""
+    prefixes = np.unique(np.asarray(prefixes, dtype=np.uint64))
+    labels = np.unique(np.asarray(labels, dtype=np.uint64))
+    with open_for_replace(path) as file:
+        file.write(header_struct.pack(trie_magic, trie_format_version, max_tokens, len(prefixes), len(labels)))
+        file.write(prefixes.astype('<u8').tobytes())
+        file.write(labels.astype('<u8').tobytes())
+
+
+@click.command('build-label-trie')
+@click.argument('dump_id', type=int)
+@with_appcontext
+def build_label_trie_command(dump_id):
+    db = get_db()
+    cursor = db.cursor(dictionary=True)
+
+    sql = 'SELECT `lang` FROM `dumps` WHERE `id`=%s'
+    cursor.execute(sql, (dump_id,))
+    tokenizer = get_tokenizer(cursor.fetchone()['lang'])
+
+    sql = 'SELECT COUNT(*) AS `labels_count` FROM `labels` WHERE `dump_id`=%s'
+    cursor.execute(sql, (dump_id,))
+    labels_count = cursor.fetchone()['labels_count']
+    print(f'labels count: {labels_count}')
+
+    sql = 'SELECT `label` FROM `labels` WHERE `dump_id`=%s'
+    cursor.execute(sql, (dump_id,))
+    prefixes = array('Q')
+    labels = array('Q')
+    max_tokens = 0
+    with tqdm(total=labels_count) as pbar:
+        for row in cursor:
+            label_name = row['label']
+            try:
+                label_tokens = [label_name[token_start:token_end]
+                                for token_start, token_end in tokenizer.span_tokenize(label_name)]
+            except ValueError:
+                print(f'cannot tokenize label: {label_name}. skipping')
+                label_tokens = []
+            if len(label_tokens) > 0:
+                for tokens_count in range(1, len(label_tokens) + 1):
+                    prefixes.append(hash_key(prefix_key(label_tokens[:tokens_count])))
+                labels.append(hash_key(label_name.encode('utf-8')))
+                max_tokens = max(max_tokens, len(label_tokens))
+            pbar.update(1)
+    cursor.close()
+
+    trie_path = get_label_trie_path(dump_id)
+    print(f'saving trie to: {trie_path}')
+    write_label_trie(trie_path, prefixes, labels, max_tokens)
+
+
+def init_app(app):
+    app.cli.add_command(build_label_trie_command)
@@ -1,9 +1,14 @@
+import bz2
+import io
 import xml.etree.ElementTree as ET
 from collections import defaultdict
 
 from mwparallelparser import Parser
 from tqdm import tqdm
 
+from .helper import pack_line_tokens
+from .pipeline import Pipeline
+
 
 def normalize_title(title):
     title = '_'.join(title.split())
@@ -12,16 +17,77 @@ def normalize_title(title):
     return title
 
 
-def iterate_xml_dump(source, tags):
+def get_xml_dump_namespace(root):
+    if root.tag.startswith('{'):  # the export schema version differs between the dumps
+        return root.tag[1:].split('}')[0]
+    return 'http://www.mediawiki.org/xml/export-0.10/'
+
+
+def compile_tag_paths(tags, mediawiki_namespace):
+    """Compile the tag paths (e.g. 'revision/text') into a tree of the qualified tags: {qualified_tag: (tag or None,
+    subtree)}, so the fields of a page are extracted in one walk over its subtree."""
+    tree = {}
+    for tag in tags:
+        node = tree
+        path = tag.split('/')
+        for depth, path_element in enumerate(path):
+            qualified_tag = '{%s}%s' % (mediawiki_namespace, path_element)
+            name, subtree = node.get(qualified_tag, (None, {}))
+            if depth == len(path) - 1:
+                name = tag
+            node[qualified_tag] = (name, subtree)
+            node = subtree
+    return tree
+
+
+def find_tags(element, tag_tree, return_elements):
+    """Set the first element matching each of the compiled tag paths as element.find does."""
+    for child in element:
+        node = tag_tree.get(child.tag)
+        if node is not None:
+            name, subtree = node
+            if name is not None and return_elements[name] is None:
+                return_elements[name] = child
+            if subtree:
+                find_tags(child, subtree, return_elements)
+
+
+def iterate_xml_dump(source, tags, main_namespace_only=False):
+    """Yield a dictionary of the elements of each page for the tag paths (None for the missing ones). The pages outside
+    the main namespace are skipped without extracting their fields if main_namespace_only is set."""
     context = ET.iterparse(source, events=("start", "end"))
     context = iter(context)
     event, root = next(context)
 
-    mediawiki_namespace = 'http://www.mediawiki.org/xml/export-0.10/'
-    namespaces = {'mediawiki': mediawiki_namespace}
+    mediawiki_namespace = get_xml_dump_namespace(root)
+    tag_tree = compile_tag_paths(tags, mediawiki_namespace)
+    page_tag = '{%s}page' % mediawiki_namespace
+    ns_tag = '{%s}ns' % mediawiki_namespace
 
     for event, element in context:
-        if event == 'end' and element.tag == '{%s}page' % mediawiki_namespace:
+        if event == 'end' and element.tag == page_tag:
+            if main_namespace_only:
+                ns = next((child.text for child in element if child.tag == ns_tag), None)
+                if ns is None or ns.strip() != '0':
+                    root.clear()
+                    continue
+            return_elements = dict.fromkeys(tags)
+            find_tags(element, tag_tree, return_elements)
+            yield return_elements
+            root.clear()
+
+
+def iterate_xml_dump_find(source, tags):
+    """The previous implementation of iterate_xml_dump calling element.find for each tag, kept for
+    the benchmark-xml-dump command."""
+    context = ET.iterparse(source, events=("start", "end"))
+    context = iter(context)
+    event, root = next(context)
+
+    namespaces = {'mediawiki': get_xml_dump_namespace(root)}
+
+    for event, element in context:
+        if event == 'end' and element.tag == '{%s}page' % namespaces['mediawiki']:
             return_elements = {}
             for tag in tags:
                 tag_path = tag.split('/')
@@ -33,53 +99,163 @@ def iterate_xml_dump(source, tags):
             root.clear()
 
 
-def iterate_xml_dump_parsed(source, metadata, early_stopping=-1):
-    titles_in_ns0 = metadata['titles_in_ns0']
+page_tags = ('ns', 'redirect', 'title', 'revision/text')
+
+
+def read_page(tag):
+    """Return the title, the redirect's destination and the wikitext of the page returned by iterate_xml_dump with
+    page_tags or None if the page is outside the main namespace. The page is passed to parse_page in the workers, so
+    it holds only strings."""
+    if tag['ns'].text.strip() != '0':
+        return None
+    redirect_to = tag['redirect'].attrib['title'] if tag['redirect'] is not None else None
+    return tag['title'].text, redirect_to, tag['revision/text'].text
+
+
+def parse_page(page, parser, lang='en'):
+    """Parse the page returned by read_page. Returns (title, [], [], redirect_to, {}) for the redirects and
+    (title, lines, lines_tokens, None, wikipedia_decisions) for the articles, where lines_tokens are the packed tokens
+    of the lines (see helper.pack_line_tokens). Raises an exception if the wikitext cannot be parsed."""
+    title, redirect_to, wikitext = page
+    title = normalize_title(title)
+    if redirect_to is not None:
+        return title, [], [], normalize_title(redirect_to), {}
+
+    wikipedia_decisions = defaultdict(list)  # line: [link]
+    wikitext_parsed = parser.parse(wikitext)
+    lines = wikitext_parsed['lines']
+    for parallel_tag in wikitext_parsed['tags']:
+        if parallel_tag['type'] == 'link':
+            destination = normalize_title(parallel_tag['attributes']['destination'])
+            line = parallel_tag['spans'][0]['line']
+            start = parallel_tag['spans'][0]['start']
+            length = parallel_tag['spans'][0]['length']
+            label = lines[line][start:start + length]
+            link = {
+                'source': title,
+                'destination': destination,
+                'line': line,
+                'start': start,
+                'length': length,
+                'label': label
+            }
+            wikipedia_decisions[line].append(link)
+    lines_tokens = [pack_line_tokens(content, lang) for content in lines]
+    return title, lines, lines_tokens, None, wikipedia_decisions
+
 
+page_parser_worker = {}
+
+
+def init_page_parser_worker(lang='en'):
+    page_parser_worker['parser'] = Parser()
+    page_parser_worker['lang'] = lang
+
+
+def parse_page_in_worker(page):
+    """Parse and tokenize the page in the pipeline's parse stage. Returns None if the wikitext cannot be parsed."""
+    try:
+        return parse_page(page, page_parser_worker['parser'], page_parser_worker['lang'])
+    except Exception as e:
+        print(f'cannot parse: {normalize_title(page[0])}')
+        return None
+
+
+def iterate_xml_dump_parsed(source, metadata, early_stopping=-1, workers=1, lang='en'):
+    """Yield the parsed pages of the main namespace. The XML is read in the pipeline's reader thread and the wikitext
+    is parsed and tokenized with the tokenizer of lang by the pool of workers."""
     if early_stopping == -1:
-        pages_to_process = len(titles_in_ns0)
+        pages_to_process = metadata['pages_in_ns0']
     else:
-        pages_to_process = min(len(titles_in_ns0), early_stopping)
+        pages_to_process = min(metadata['pages_in_ns0'], early_stopping)
 
-    parser = Parser()
+    pages = map(read_page, iterate_xml_dump(source, page_tags, main_namespace_only=True))
+    pipeline = Pipeline(pages, parse_page_in_worker, workers, initializer=init_page_parser_worker, initargs=(lang,))
     with tqdm(total=pages_to_process) as pbar:
-        for tag in iterate_xml_dump(source, ('ns', 'redirect', 'title', 'revision/text')):
-            ns = tag['ns'].text.strip()
-            if ns == '0':
-                if tag['redirect'] is not None:
-                    title = normalize_title(tag['title'].text)
-                    redirect_to = normalize_title(tag['redirect'].attrib['title'])
-                    yield title, [], redirect_to, {}
-                else:
-                    title = tag['title'].text
-                    title = normalize_title(title)
-                    wikitext = tag['revision/text'].text
-                    wikipedia_decisions = defaultdict(list)  # line: [link]
-                    try:
-                        wikitext_parsed = parser.parse(wikitext)
-                        lines = wikitext_parsed['lines']
-                        for parallel_tag in wikitext_parsed['tags']:
-                            if parallel_tag['type'] == 'link':
-                                destination = normalize_title(parallel_tag['attributes']['destination'])
-                                line = parallel_tag['spans'][0]['line']
-                                start = parallel_tag['spans'][0]['start']
-                                length = parallel_tag['spans'][0]['length']
-                                label = lines[line][start:start + length]
-                                link = {
-                                    'source': title,
-                                    'destination': destination,
-                                    'line': line,
-                                    'start': start,
-                                    'length': length,
-                                    'label': label
-                                }
-                                wikipedia_decisions[line].append(link)
-                        yield title, lines, None, wikipedia_decisions
-                    except Exception as e:
-                        print(f'cannot parse: {title}')
-
-                pbar.set_description(f'parsing: {title[:25]: <25}')
-                pbar.update(1)
-                pages_to_process -= 1
-                if pages_to_process <= 0:
-                    return
+        for page in pipeline:
+            if page is not None:
+                yield page
+
+            pbar.set_postfix(pipeline.stats(), refresh=False)
+            pbar.update(1)
+            pages_to_process -= 1
+            if pages_to_process <= 0:
+                return
+
+
+def read_multistream_index(index_path):
+    """Return the sorted offsets of the bz2 streams from the multistream index (lines of offset:page_id:title)."""
+    offsets = set()
+    with bz2.open(index_path, 'rt', encoding='utf-8') as index_file:
+        for line in index_file:
+            offsets.add(int(line.split(':', 1)[0]))
+    return sorted(offsets)
+
+
+def read_multistream_block(dump_file, offset, length):
+    """Decompress the bz2 stream and return its pages wrapped in the root element of the dump. Each stream holds about
+    a hundred pages. The first stream starts with the siteinfo and the last one ends with the closing root tag."""
+    dump_file.seek(offset)
+    data = bz2.decompress(dump_file.read(length) if length is not None else dump_file.read())
+    pages_start = data.find(b'<page>')
+    pages_end = data.rfind(b'</page>')
+    if pages_start == -1 or pages_end == -1:
+        return None
+    pages = data[pages_start:pages_end + len(b'</page>')]
+    return b'<mediawiki xmlns="' + multistream_worker['namespace'].encode() + b'">' + pages + b'</mediawiki>'
+
+
+multistream_worker = {}
+
+
+def init_multistream_worker(dump_path, namespace, lang):
+    multistream_worker['dump_file'] = open(dump_path, 'rb')
+    multistream_worker['namespace'] = namespace
+    init_page_parser_worker(lang)
+
+
+def parse_multistream_block(block):
+    """Parse all the pages of the block in the worker. Returns the parsed pages in the dump order and the number of the
+    pages in the main namespace."""
+    offset, length = block
+    xml_block = read_multistream_block(multistream_worker['dump_file'], offset, length)
+    if xml_block is None:
+        return [], 0
+    pages = []
+    ns0_pages_count = 0
+    for tag in iterate_xml_dump(io.BytesIO(xml_block), page_tags, main_namespace_only=True):
+        ns0_pages_count += 1
+        page = parse_page_in_worker(read_page(tag))
+        if page is not None:
+            pages.append(page)
+    return pages, ns0_pages_count
+
+
+def get_multistream_namespace(dump_path):
+    """Read the namespace of the export schema from the root element in the first stream."""
+    with bz2.open(dump_path, 'rb') as dump_file:
+        header = dump_file.read(1024)
+    start = header.find(b'xmlns="') + len(b'xmlns="')
+    return header[start:header.find(b'"', start)].decode()
+
+
+def iterate_multistream_dump_parsed(dump_path, index_path, workers=1, early_stopping=-1, lang='en'):
+    """Parse the multistream dump in a pool of processes. Each worker decompresses and parses whole bz2 streams. The
+    results are returned in the dump order, so the pages are yielded as by iterate_xml_dump_parsed."""
+    offsets = read_multistream_index(index_path)
+    blocks = [(offset, next_offset - offset) for offset, next_offset in zip(offsets, offsets[1:])]
+    blocks.append((offsets[-1], None))  # the last stream ends with the end of the file
+    initargs = (dump_path, get_multistream_namespace(dump_path), lang)
+
+    pipeline = Pipeline(blocks, parse_multistream_block, workers, initializer=init_multistream_worker,
+                        initargs=initargs, queue_size=4 * workers, chunk_size=1)
+    pages_processed = 0
+    with tqdm(total=len(blocks), desc='parsing streams') as pbar:
+        for pages, ns0_pages_count in pipeline:
+            for page in pages:
+                yield page
+            pages_processed += ns0_pages_count
+            pbar.set_postfix(pages=pages_processed, **pipeline.stats(), refresh=False)
+            pbar.update(1)
+            if early_stopping != -1 and pages_processed >= early_stopping:
+                return
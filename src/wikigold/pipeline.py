@@ -0,0 +1,116 @@
+"""
+Staged pipeline of the dump importers: reader -> parse pool -> writer.
+
+The reader stage iterates over the items (e.g. the dump lines) in a thread, the parse stage runs in a pool of processes
+and the writer stage is the loop consuming the pipeline, so reading, parsing and the database writes overlap. The
+stages are connected by bounded queues: the reader blocks when the parse stage has queue_size items waiting and
+the parse stage gets no new items while queue_size items are parsed or wait for the writer. The results are returned
+in the order of the items.
+"""
+
+import multiprocessing
+import queue
+import threading
+import time
+
+# marks the end of the items in the read queue
+end_of_items = object()
+
+
+class Pipeline:
+    def __init__(self, items, parse, workers=1, initializer=None, initargs=(), queue_size=256, chunk_size=16):
+        """parse is called with each item in the workers (or in this process if workers is 1) after the initializer.
+        Both must be module level functions."""
+        self.items = items
+        self.parse = parse
+        self.workers = workers
+        self.initializer = initializer
+        self.initargs = initargs
+        self.queue_size = max(queue_size, chunk_size)  # the pool waits for the whole chunk before parsing it
+        self.chunk_size = chunk_size
+
+        self.read_queue = queue.Queue(maxsize=self.queue_size)
+        self.parse_slots = threading.Semaphore(self.queue_size)
+        self.stopped = threading.Event()
+        self.reader_exception = None
+
+        # each counter is updated by a single thread
+        self.read_count = 0
+        self.dispatched_count = 0
+        self.parsed_count = 0
+        self.start_time = None
+
+    def put(self, item):
+        """Put the item into the read queue unless the pipeline is stopped while waiting for the free space."""
+        while not self.stopped.is_set():
+            try:
+                self.read_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read(self):
+        """The reader stage."""
+        try:
+            for item in self.items:
+                if not self.put(item):
+                    return
+                self.read_count += 1
+        except Exception as e:
+            self.reader_exception = e
+        self.put(end_of_items)
+
+    def parse_input(self):
+        # the waits are interrupted when the pipeline is stopped, so the pool's task handler can be joined
+        while not self.stopped.is_set():
+            try:
+                item = self.read_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is end_of_items:
+                if self.reader_exception is not None:
+                    raise self.reader_exception
+                return
+            while not self.parse_slots.acquire(timeout=0.1):  # released when the writer gets the result
+                if self.stopped.is_set():
+                    return
+            self.dispatched_count += 1
+            yield item
+
+    def __iter__(self):
+        self.start_time = time.time()
+        # the workers are forked before the reader thread is started
+        if self.workers > 1:
+            pool = multiprocessing.get_context('fork').Pool(self.workers, initializer=self.initializer,
+                                                            initargs=self.initargs)
+            results = pool.imap(self.parse, self.parse_input(), chunksize=self.chunk_size)
+        else:
+            pool = None
+            if self.initializer is not None:
+                self.initializer(*self.initargs)
+            results = map(self.parse, self.parse_input())
+
+        reader = threading.Thread(target=self.read, daemon=True)
+        reader.start()
+
+        try:
+            for result in results:
+                self.parsed_count += 1
+                self.parse_slots.release()
+                yield result
+        finally:
+            self.stopped.set()
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def stats(self):
+        """Return the throughput of the reader and parse stages and the depths of their queues for the progress bar."""
+        elapsed = max(time.time() - self.start_time, 1e-9) if self.start_time is not None else 1e-9
+        return {
+            'read/s': f'{self.read_count / elapsed:.1f}',
+            'read_queue': self.read_queue.qsize(),
+            'parsed/s': f'{self.parsed_count / elapsed:.1f}',
+            'parse_queue': self.dispatched_count - self.parsed_count,
+        }
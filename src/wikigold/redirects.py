@@ -0,0 +1,227 @@
+"""
+Redirect resolution of a dump shared by the commands and the API.
+
+The redirects are held in two structures built from the articles of the dump:
+1. a dense array of the final targets of the redirect chains indexed by the article id (an article that is not
+   a redirect is its own target),
+2. a title index: the 64-bit title hashes sorted with the articles' ids, searched with binary search.
+
+The title hashes are the ones of the articles' title_hash column (see titlehash.py). The structures are built from
+the database or saved with build-redirects and memory-mapped, so all the gunicorn workers share the pages of the file.
+
+File layout:
+1. header: magic, format version, first article id, number of the targets, number of the titles, number of the
+   redirects (checked against the articles of the dump, so a file left by an earlier import is not used)
+2. uint32 targets
+3. uint64 sorted title hashes (aligned to 8 bytes)
+4. uint32 article ids of the title hashes
+"""
+
+import mmap
+import os.path
+import struct
+
+import click
+import numpy as np
+from flask import current_app
+from flask.cli import with_appcontext
+from tqdm import tqdm
+
+from .db import get_db
+from .helper import get_data_dir, open_for_replace
+from .titlehash import title_hashes
+
+redirects_magic = b'WGRD'
+redirects_format_version = 2
+
+# magic, version, first id, targets count, titles count, redirects count
+header_struct = struct.Struct('<4sIQQQQ')
+
+loaded_redirects = {}
+# dump id: modification time of the redirects file which does not match the articles of the dump
+stale_redirects = {}
+
+
+def resolve_redirect_chains(redirect_targets, first_id, max_iterations=64):
+    """Resolve the redirect chains with pointer jumping: each step replaces the target with the target's target,
+    so the chains of length n are resolved in log2(n) vectorized steps."""
+    for _ in range(max_iterations):
+        next_targets = redirect_targets[redirect_targets.astype(np.int64) - first_id]
+        if np.array_equal(next_targets, redirect_targets):
+            return redirect_targets
+        redirect_targets = next_targets
+    print('redirect cycles detected. some redirects are not resolved')
+    return redirect_targets
+
+
+class Redirects:
+    def __init__(self, first_id, targets, hashes, hashes_ids, redirects_count):
+        """Element i of targets is the final target of the article with id first_id + i. hashes are the sorted title
+        hashes and hashes_ids the ids of their articles. redirects_count is the number of the articles with
+        redirect_to_title."""
+        self.first_id = first_id
+        self.targets = targets
+        self.hashes = hashes
+        self.hashes_ids = hashes_ids
+        self.redirects_count = redirects_count
+
+    def matches(self, articles_stats):
+        """Check that the redirects were built from the articles described by get_articles_stats."""
+        first_id, last_id, articles_count, redirects_count = articles_stats
+        if articles_count == 0:
+            return len(self.hashes) == 0
+        return (self.first_id == first_id and len(self.targets) == last_id - first_id + 1
+                and len(self.hashes) == articles_count and self.redirects_count == redirects_count)
+
+    def resolve(self, article_ids):
+        """Return the array of the final targets of the articles. The ids outside the dump are returned unchanged."""
+        article_ids = np.asarray(article_ids, dtype=np.int64)
+        resolved = article_ids.copy()
+        in_dump = (article_ids >= self.first_id) & (article_ids < self.first_id + len(self.targets))
+        resolved[in_dump] = self.targets[article_ids[in_dump] - self.first_id]
+        return resolved
+
+    def lookup_titles(self, titles):
+        """Return the list of the articles' ids of the titles (None for the titles not in the dump)."""
+        if len(self.hashes) == 0:
+            return [None] * len(titles)
+        hashes = title_hashes(titles, len(titles))
+        positions = np.minimum(np.searchsorted(self.hashes, hashes), len(self.hashes) - 1)
+        found = self.hashes[positions] == hashes
+        return [int(self.hashes_ids[position]) if is_found else None
+                for position, is_found in zip(positions, found)]
+
+    def save(self, path):
+        with open_for_replace(path) as file:  # the workers may have the redirects mapped
+            file.write(header_struct.pack(redirects_magic, redirects_format_version, self.first_id,
+                                          len(self.targets), len(self.hashes), self.redirects_count))
+            file.write(self.targets.astype('<u4').tobytes())
+            file.write(b'\0' * (-file.tell() % 8))
+            file.write(self.hashes.astype('<u8').tobytes())
+            file.write(self.hashes_ids.astype('<u4').tobytes())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as file:
+            mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, first_id, targets_count, titles_count, redirects_count = header_struct.unpack_from(mm)
+        if magic != redirects_magic or version != redirects_format_version:
+            raise ValueError(f'unsupported redirects: {path}')
+        offset = header_struct.size
+        targets = np.frombuffer(mm, dtype='<u4', count=targets_count, offset=offset)
+        offset += targets.nbytes
+        offset += -offset % 8
+        hashes = np.frombuffer(mm, dtype='<u8', count=titles_count, offset=offset)
+        offset += hashes.nbytes
+        hashes_ids = np.frombuffer(mm, dtype='<u4', count=titles_count, offset=offset)
+        return cls(first_id, targets, hashes, hashes_ids, redirects_count)
+
+
+def get_articles_stats(dump_id):
+    """Return the first and the last id, the number of the articles and the number of the redirects of the dump."""
+    cursor = get_db().cursor()
+    sql = 'SELECT MIN(`id`), MAX(`id`), COUNT(*), COUNT(`redirect_to_title`) FROM `articles` WHERE `dump_id`=%s'
+    cursor.execute(sql, (dump_id,))
+    articles_stats = cursor.fetchone()
+    cursor.close()
+    return articles_stats
+
+
+def load_redirects_from_db(dump_id, fetch_size=100000):
+    """Build the redirects of the dump from the hashes of the articles' title and redirect_to_title, so the chains are
+    resolved without the redirect_to_id set in step 5 of the import."""
+    first_id, last_id, articles_count, redirects_count = get_articles_stats(dump_id)
+    if articles_count == 0:
+        return Redirects(0, np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.uint32),
+                         0)
+
+    db = get_db()
+    cursor = db.cursor()
+
+    ids = np.zeros(articles_count, dtype=np.uint32)
+    hashes = np.zeros(articles_count, dtype=np.uint64)
+    redirects_ids = []
+    redirects_hashes = []
+
+    sql = 'SELECT `id`, `title_hash`, `redirect_to_title_hash` FROM `articles` WHERE `dump_id`=%s'
+    cursor.execute(sql, (dump_id,))
+    articles_loaded = 0
+    with tqdm(total=articles_count, desc='loading titles') as pbar:
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if len(rows) == 0:
+                break
+            rows_slice = slice(articles_loaded, articles_loaded + len(rows))
+            ids[rows_slice] = np.fromiter((row[0] for row in rows), dtype=np.uint32, count=len(rows))
+            hashes[rows_slice] = np.fromiter((row[1] for row in rows), dtype=np.uint64, count=len(rows))
+            for article_id, _, redirect_to_title_hash in rows:
+                if redirect_to_title_hash is not None:
+                    redirects_ids.append(article_id)
+                    redirects_hashes.append(redirect_to_title_hash)
+            articles_loaded += len(rows)
+            pbar.update(len(rows))
+    cursor.close()
+
+    order = np.argsort(hashes, kind='stable')
+    redirects = Redirects(first_id, np.arange(first_id, last_id + 1, dtype=np.uint32), hashes[order], ids[order],
+                          redirects_count)
+
+    # the redirects to the titles missing in the dump stay their own targets
+    redirects_ids = np.array(redirects_ids, dtype=np.int64)
+    redirects_hashes = np.array(redirects_hashes, dtype=np.uint64)
+    positions = np.minimum(np.searchsorted(redirects.hashes, redirects_hashes), len(redirects.hashes) - 1)
+    found = redirects.hashes[positions] == redirects_hashes
+    redirects.targets[redirects_ids[found] - first_id] = redirects.hashes_ids[positions[found]]
+    redirects.targets = resolve_redirect_chains(redirects.targets, first_id)
+
+    return redirects
+
+
+def get_redirects_path(dump_id):
+    return os.path.join(get_data_dir(), f'redirects-{dump_id}.bin')
+
+
+def get_redirects(dump_id=None, load_from_db=True):
+    """Return the redirects of the dump. The file saved with build-redirects is mapped if it matches the articles of
+    the dump, otherwise the redirects are loaded from the database (or None is returned if load_from_db is False).
+    The redirects are loaded once per process and a stale file is checked again only after it is rebuilt."""
+    if dump_id is None:
+        dump_id = current_app.config['KNOWLEDGE_BASE']
+
+    if dump_id not in loaded_redirects:
+        path = get_redirects_path(dump_id)
+        redirects = None
+        if os.path.exists(path) and stale_redirects.get(dump_id) != os.path.getmtime(path):
+            redirects = Redirects.load(path)
+            if not redirects.matches(get_articles_stats(dump_id)):
+                print(f'redirects {path} do not match the articles of dump {dump_id}. run build-redirects again')
+                stale_redirects[dump_id] = os.path.getmtime(path)
+                redirects = None
+        if redirects is not None:
+            loaded_redirects[dump_id] = redirects
+        elif load_from_db:
+            loaded_redirects[dump_id] = load_redirects_from_db(dump_id)
+        else:
+            return None
+
+    return loaded_redirects[dump_id]
+
+
+@click.command('build-redirects')
+@click.argument('dump_id', type=int)
+@with_appcontext
+def build_redirects_command(dump_id):
+    """Save the redirects of the imported dump for the API and the commands."""
+    redirects = load_redirects_from_db(dump_id)
+    redirects_count = int(np.count_nonzero(
+        redirects.targets != np.arange(redirects.first_id, redirects.first_id + len(redirects.targets))))
+    print(f'titles: {len(redirects.hashes)} resolved redirects: {redirects_count}')
+
+    path = get_redirects_path(dump_id)
+    print(f'saving redirects to: {path}')
+    redirects.save(path)
+
+
+def init_app(app):
+    app.cli.add_command(build_redirects_command)
@@ -1,4 +1,6 @@
-from .cache import get_cached_label
+from .bloomfilter import get_label_bloom_filter
+from .cache import get_cached_labels
+from .labeltrie import get_label_trie, match_labels
 from flask import current_app
 from nltk.corpus import stopwords
 
@@ -56,66 +58,70 @@ def apply_links_to_text_ratio(lines, labels, rate_keywords_by, links_to_text_rat
 
 def get_label_titles_dict(candidate_labels, algorithm_normalized_json):
     """Return a dictionary for all labels found in the article. The dictionary gets the labels' statistics from the cache.
-    The dictionary maps label_name to {'label_counter': int, 'keyphraseness': int, 'articles': {...}}"""
+    The dictionary maps label_name to {'label_counter': int, 'keyphraseness': int, 'articles': [...]}
+
+    The keyphraseness and sense probabilities are precomputed in the cache and the articles are sorted by descending
+    sense probability, so all the filters are applied in a single pass."""
     candidate_labels_unique = set(map(lambda candidate_label: candidate_label['name'], candidate_labels))
+    label_bloom_filter = get_label_bloom_filter()
+    if label_bloom_filter is not None:  # skip the cache lookups for n-grams that are surely not labels
+        candidate_labels_unique = label_bloom_filter.filter(candidate_labels_unique)
+    min_label_articles_count = algorithm_normalized_json['min_label_articles_count']
+    min_sense_probability = algorithm_normalized_json['min_sense_probability']
+    min_label_sense_probability = algorithm_normalized_json['min_label_sense_probability']
+
     label_articles_dict = {}
-    for label_name in candidate_labels_unique:
-        label = get_cached_label(label_name)
-        if label is not None:
-            if label['label_counter'] >= algorithm_normalized_json['min_label_count']:
-                if 'as_link_in' in label and 'appeared_in' in label:  # we have 'as_link_in' and 'appeared_in' cached
-                    if label['appeared_in'] != 0:
-                        label['keyphraseness'] = label['as_link_in'] / label['appeared_in']
-                    else:
-                        label['keyphraseness'] = 0.0
-                    if label['keyphraseness'] >= algorithm_normalized_json['min_keyphraseness']:
-                        label_articles_dict[label_name] = label
-                else:
-                    label_articles_dict[label_name] = label
-
-            # calculate sense probability for articles
-            article_counter_sum = sum([article['article_counter'] for article in label['articles'].values()])
-            for article in label['articles'].values():
-                article['sense_probability'] = article['article_counter'] / article_counter_sum
-
-            # calculate label sense probability for articles
-            label_article_counter_sum = sum([article['label_article_counter'] for article in label['articles'].values()])
-            for article in label['articles'].values():
-                article['label_sense_probability'] = article['label_article_counter'] / label_article_counter_sum
-
-    # apply filter on min L-A counter
-    for label in label_articles_dict.values():
-        label['articles'] = {article_id: article for article_id, article in label['articles'].items()
-                             if
-                             article['label_article_counter'] >= algorithm_normalized_json['min_label_articles_count']}
-
-    # apply filter on min sense probability
-    for label in label_articles_dict.values():
-        label['articles'] = {article_id: article for article_id, article in label['articles'].items()
-                             if article['sense_probability'] >= algorithm_normalized_json['min_sense_probability']}
-
-    # apply filter on min label sense probability
-    for label in label_articles_dict.values():
-        label['articles'] = {article_id: article for article_id, article in label['articles'].items()
-                             if article['label_sense_probability'] >= algorithm_normalized_json[
-                                 'min_label_sense_probability']}
-
-    # Remove labels with empty titles
-    label_articles_dict = {label_name: label for label_name, label in label_articles_dict.items()
-                           if len(label['articles']) > 0}
-
-    # it's more natural for JS to have articles as list, not dictionary
-    for label in label_articles_dict.values():
-        label['articles'] = [{'article_id': article_id,
-                              'article_counter': article['article_counter'],
-                              'label_article_counter': article['label_article_counter'],
-                              'sense_probability': article['sense_probability'],
-                              'label_sense_probability': article['label_sense_probability'],
-                              } for article_id, article in label['articles'].items()]
+    for label_name, label in get_cached_labels(candidate_labels_unique).items():
+        if label['label_counter'] < algorithm_normalized_json['min_label_count']:
+            continue
+        # we have 'keyphraseness' only if 'as_link_in' and 'appeared_in' are cached
+        if 'keyphraseness' in label and label['keyphraseness'] < algorithm_normalized_json['min_keyphraseness']:
+            continue
+
+        # it's more natural for JS to have articles as list, not dictionary
+        articles = []
+        for article_id, article in label['articles'].items():
+            if article['sense_probability'] < min_sense_probability:
+                break  # the rest of the articles have lower sense probability
+            if article['label_article_counter'] >= min_label_articles_count and \
+                    article['label_sense_probability'] >= min_label_sense_probability:
+                articles.append({'article_id': article_id,
+                                 'article_counter': article['article_counter'],
+                                 'label_article_counter': article['label_article_counter'],
+                                 'sense_probability': article['sense_probability'],
+                                 'label_sense_probability': article['label_sense_probability'],
+                                 })
+
+        # Remove labels with empty titles
+        if len(articles) > 0:
+            label['articles'] = articles
+            label_articles_dict[label_name] = label
 
     return label_articles_dict
 
 
+def get_labels_from_candidates(lines, candidate_labels, algorithm_normalized_json):
+    """Keep only the candidate labels that are known labels and apply the keyword ratings."""
+    label_titles_dict = get_label_titles_dict(candidate_labels, algorithm_normalized_json)
+    labels = []
+    for candidate_label in candidate_labels:
+        label_name = candidate_label['name']
+        if label_name in label_titles_dict:
+            # copy label metadata from the labels' dictionary to all labels
+            candidate_label['label_counter'] = label_titles_dict[label_name]['label_counter']
+            candidate_label['articles'] = label_titles_dict[label_name]['articles']
+            if 'keyphraseness' in label_titles_dict[label_name]:
+                candidate_label['keyphraseness'] = label_titles_dict[label_name]['keyphraseness']
+            labels.append(candidate_label)
+
+    # Apply keyword ratings if specified
+    if algorithm_normalized_json['rate_keywords_by'] != '':
+        labels = apply_links_to_text_ratio(lines, labels, algorithm_normalized_json['rate_keywords_by'],
+                                           algorithm_normalized_json['links_to_text_ratio'])
+
+    return labels
+
+
 def get_labels_exact(lines, algorithm_normalized_json):
     stops = set(stopwords.words('english'))
 
@@ -144,21 +150,18 @@ def get_labels_exact(lines, algorithm_normalized_json):
                     'ngrams': ngrams,
                 })
 
-    label_titles_dict = get_label_titles_dict(candidate_labels, algorithm_normalized_json)
-    labels = []
-    for candidate_label in candidate_labels:
-        label_name = candidate_label['name']
-        if label_name in label_titles_dict:
-            # copy label metadata from the labels' dictionary to all labels
-            candidate_label['label_counter'] = label_titles_dict[label_name]['label_counter']
-            candidate_label['articles'] = label_titles_dict[label_name]['articles']
-            if 'keyphraseness' in label_titles_dict[label_name]:
-                candidate_label['keyphraseness'] = label_titles_dict[label_name]['keyphraseness']
-            labels.append(candidate_label)
+    return get_labels_from_candidates(lines, candidate_labels, algorithm_normalized_json)
 
-    # Apply keyword ratings if specified
-    if algorithm_normalized_json['rate_keywords_by'] != '':
-        labels = apply_links_to_text_ratio(lines, labels, algorithm_normalized_json['rate_keywords_by'],
-                                           algorithm_normalized_json['links_to_text_ratio'])
 
-    return labels
+def get_labels_trie(lines, algorithm_normalized_json):
+    """Find the labels with the labels' trie in a single pass over the tokens. Unlike get_labels_exact only the n-grams
+    which are labels are looked up, and MAX_NGRAMS is a soft limit, so the longer labels are found too."""
+    stops = set(stopwords.words('english'))
+
+    candidate_labels = [candidate_label
+                        for candidate_label in match_labels(lines, get_label_trie(), current_app.config['MAX_NGRAMS'])
+                        if not (algorithm_normalized_json['skip_stop_words'] and candidate_label['name'] in stops)]
+    # keep the order of get_labels_exact
+    candidate_labels.sort(key=lambda label: (label['ngrams'], label['line'], label['start']))
+
+    return get_labels_from_candidates(lines, candidate_labels, algorithm_normalized_json)
@@ -25,6 +25,8 @@ CREATE TABLE `articles` (
     `redirect_to_id` INT UNSIGNED NULL,
     `dump_id` INT UNSIGNED NULL,
     `counter` INT UNSIGNED NOT NULL DEFAULT 0,
+    `title_hash` BIGINT UNSIGNED AS (CAST(CONV(LEFT(MD5(`title`), 16), 16, 10) AS UNSIGNED)) STORED,  # titlehash.title_hash
+    `redirect_to_title_hash` BIGINT UNSIGNED AS (CAST(CONV(LEFT(MD5(`redirect_to_title`), 16), 16, 10) AS UNSIGNED)) STORED,
     FOREIGN KEY (`dump_id`) REFERENCES `dumps` (`id`),
     FOREIGN KEY (`redirect_to_id`) REFERENCES `articles` (`id`),
     PRIMARY KEY (`id`)
@@ -43,6 +45,7 @@ CREATE TABLE `lines` (
     `id` INT UNSIGNED NOT NULL AUTO_INCREMENT,
     `nr` INT UNSIGNED NOT NULL,
     `content` LONGTEXT NOT NULL,
+    `tokens` LONGBLOB NULL,  # packed uint32 (start, end) token spans, NULL if not tokenized yet
     `article_id` INT UNSIGNED NOT NULL,
     FOREIGN KEY (`article_id`) REFERENCES `articles` (`id`),
     PRIMARY KEY (`id`)
@@ -79,6 +82,7 @@ CREATE TABLE `labels` (
     `label` VARCHAR(255) NOT NULL,
     `dump_id` INT UNSIGNED NULL,
     `counter` INT UNSIGNED NOT NULL DEFAULT 0,
+    `label_hash` BIGINT UNSIGNED AS (CAST(CONV(LEFT(MD5(`label`), 16), 16, 10) AS UNSIGNED)) STORED,
     FOREIGN KEY (`dump_id`) REFERENCES `dumps` (`id`),
     PRIMARY KEY (`id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin;
@@ -116,6 +120,8 @@ CREATE TABLE `ground_truth_decisions` (
     `destination_title` VARCHAR(255) NOT NULL,
     `destination_article_id` INT UNSIGNED NULL,
     `ground_truth_id` INT UNSIGNED NOT NULL,
+    `label_hash` BIGINT UNSIGNED AS (CAST(CONV(LEFT(MD5(`label`), 16), 16, 10) AS UNSIGNED)) STORED,
+    `destination_title_hash` BIGINT UNSIGNED AS (CAST(CONV(LEFT(MD5(`destination_title`), 16), 16, 10) AS UNSIGNED)) STORED,
     FOREIGN KEY (`source_article_id`) REFERENCES `articles` (`id`),
     FOREIGN KEY (`source_line_id`) REFERENCES `lines` (`id`),
     FOREIGN KEY (`label_id`) REFERENCES `labels` (`id`),
@@ -124,5 +130,20 @@ CREATE TABLE `ground_truth_decisions` (
     PRIMARY KEY (`id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin;
 
+CREATE TABLE `import_progress` (
+    `dump_id` INT UNSIGNED NOT NULL,
+    `step` INT UNSIGNED NOT NULL,
+    `position` BIGINT UNSIGNED NOT NULL,  # last id of the finished chunks or byte offset in the file for step 1
+    `filename` VARCHAR(255) NULL,  # dump file of step 1
+    `articles_processed` INT UNSIGNED NULL,  # articles read in step 1
+    PRIMARY KEY (`dump_id`, `step`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin;
+
 CREATE INDEX articles_ix_title ON articles(title);
 CREATE INDEX labels_ix_label ON labels(label);
+CREATE INDEX ground_truth_decisions_ix_destination_article_id
+    ON ground_truth_decisions(ground_truth_id, destination_article_id);
+CREATE INDEX ground_truth_decisions_ix_label_id
+    ON ground_truth_decisions(ground_truth_id, label_id, destination_title, destination_article_id);
+CREATE INDEX articles_ix_dump_id_title_hash ON articles(dump_id, title_hash);
+CREATE INDEX labels_ix_dump_id_label_hash ON labels(dump_id, label_hash);
@@ -0,0 +1,83 @@
+"""
+64-bit hashes of the titles and labels used for the joins of the importers and the title lookups.
+
+The hash is the first 8 bytes of the MD5 of the utf-8 encoded string (big-endian). The tables store it in generated
+columns computed by the database, so the importers insert only the strings, and the joins compare the narrow indexed
+hashes first and the strings only for the matching hashes.
+
+The columns are created by schema.sql. The databases created before they were introduced are migrated explicitly with
+the migrate-title-hashes command, the importers only check that the columns exist.
+"""
+
+import hashlib
+
+import click
+import numpy as np
+from flask.cli import with_appcontext
+
+from .db import get_db
+
+
+def title_hash(title):
+    return int.from_bytes(hashlib.md5(title.encode('utf-8')).digest()[:8], 'big')
+
+
+def title_hashes(titles, count=-1):
+    return np.fromiter((title_hash(title) for title in titles), dtype=np.uint64, count=count)
+
+
+def sql_title_hash(column):
+    """Return the SQL expression of the hash of the column, the same as title_hash."""
+    return f'CAST(CONV(LEFT(MD5({column}), 16), 16, 10) AS UNSIGNED)'
+
+
+# table, hash column, hashed column
+title_hash_columns = [
+    ('articles', 'title_hash', '`title`'),
+    ('articles', 'redirect_to_title_hash', '`redirect_to_title`'),
+    ('labels', 'label_hash', '`label`'),
+    ('ground_truth_decisions', 'destination_title_hash', '`destination_title`'),
+    ('ground_truth_decisions', 'label_hash', '`label`'),
+]
+
+title_hash_indexes = [
+    ('articles', 'articles_ix_dump_id_title_hash', '`dump_id`, `title_hash`'),
+    ('labels', 'labels_ix_dump_id_label_hash', '`dump_id`, `label_hash`'),
+]
+
+
+def check_title_hash_columns(cursor):
+    """Raise an exception if the database was created before the hash columns were introduced."""
+    sql = 'SELECT COUNT(*) FROM information_schema.columns ' \
+          'WHERE table_schema=DATABASE() AND table_name=%s AND column_name=%s'
+    for table, column, _ in title_hash_columns:
+        cursor.execute(sql, (table, column))
+        if cursor.fetchone()[0] == 0:
+            raise Exception(f'column {table}.{column} not found. run migrate-title-hashes first')
+
+
+def add_title_hash_columns(cursor):
+    """Add the hash columns and their indexes to the databases created before they were introduced. The columns are
+    computed for all the existing rows, so the call may take long."""
+    for table, column, hashed_column in title_hash_columns:
+        cursor.execute(f'ALTER TABLE `{table}` ADD COLUMN IF NOT EXISTS `{column}` BIGINT UNSIGNED '
+                       f'AS ({sql_title_hash(hashed_column)}) STORED')
+    for table, index, columns in title_hash_indexes:
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS `{index}` ON `{table}`({columns})')
+
+
+@click.command('migrate-title-hashes')
+@with_appcontext
+def migrate_title_hashes_command():
+    """Add the title hash columns to a database created before they were introduced. The articles, labels and
+    ground_truth_decisions tables are rebuilt, which may take long on large databases."""
+    db = get_db()
+    cursor = db.cursor()
+    add_title_hash_columns(cursor)
+    db.commit()
+    cursor.close()
+    click.echo('title hashes migrated')
+
+
+def init_app(app):
+    app.cli.add_command(migrate_title_hashes_command)
@@ -0,0 +1,75 @@
+"""
+Process-wide registry of the tokenizers used to split lines into tokens.
+
+The punkt model of each language is unpickled only once per process and the tokenizer is reused for every line.
+"""
+
+from nltk import TreebankWordTokenizer
+from nltk.data import load
+
+# maps Wikipedia language codes (the `dumps`.`lang` column) to punkt models
+punkt_languages = {
+    'cs': 'czech',
+    'da': 'danish',
+    'de': 'german',
+    'el': 'greek',
+    'en': 'english',
+    'es': 'spanish',
+    'et': 'estonian',
+    'fi': 'finnish',
+    'fr': 'french',
+    'it': 'italian',
+    'nl': 'dutch',
+    'no': 'norwegian',
+    'pl': 'polish',
+    'pt': 'portuguese',
+    'ru': 'russian',
+    'simple': 'english',
+    'sl': 'slovene',
+    'sv': 'swedish',
+    'tr': 'turkish',
+}
+
+default_language = 'english'
+
+tokenizers = {}
+
+
+class Tokenizer:
+    def __init__(self, language):
+        self.language = language
+        self.sent_tokenizer = load(f'tokenizers/punkt/{language}.pickle')
+        self.word_tokenizer = TreebankWordTokenizer()
+
+    def span_tokenize(self, text):
+        sentence_spans = self.sent_tokenizer.span_tokenize(text)
+        for (sentence_span_start, sentence_span_end) in sentence_spans:
+            sentence = text[sentence_span_start:sentence_span_end]
+            word_spans = self.word_tokenizer.span_tokenize(sentence)
+            for (token_span_start, token_span_end) in word_spans:
+                yield sentence_span_start + token_span_start, sentence_span_start + token_span_end
+
+    def tokenize_lines(self, lines):
+        """Return the list of (start, end) token spans for each line. Raises ValueError if any line cannot be
+        tokenized."""
+        return [list(self.span_tokenize(line)) for line in lines]
+
+
+def get_language(lang):
+    """Resolve a dump language code (or a punkt language name) to the punkt language name."""
+    if lang in punkt_languages:
+        return punkt_languages[lang]
+    elif lang in punkt_languages.values():
+        return lang
+    return default_language
+
+
+def get_tokenizer(lang='en'):
+    language = get_language(lang)
+    if language not in tokenizers:
+        tokenizers[language] = Tokenizer(language)
+    return tokenizers[language]
+
+
+def tokenize_lines(lines, lang='en'):
+    return get_tokenizer(lang).tokenize_lines(lines)